@@ -1,7 +1,7 @@
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import spotipy
+from spotipy import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
 import os
 import logging
@@ -10,6 +10,31 @@ from collections import defaultdict
 import re
 import requests
 import json
+import hashlib
+import itertools
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from clustering import cluster_library
+from feature_store import COLUMN_INDEX, feature_store
+from genre_index import genre_index
+from jobs import FINISHED_STATUSES, JobCancelled, JobQueueFull, job_manager
+from library_cache import sync_liked_songs, sync_playlist, update_liked_songs
+from library_export import EXPORT_FORMATS, export_rows, parse_fields, to_csv, to_ndjson
+from library_stats import library_stats
+from metrics import registry as metrics_registry
+from metrics import Gauge, request_timings, server_timing_header, stage, start_request_timings
+from paging import iter_pages
+from playlist_writer import PlaylistWriteError, resume_write, update_playlist, write_playlist, write_playlists
+from prompt_parser import parse_prompt
+from rate_limit import priority
+from ranking import FEATURE_WEIGHTS, rank_by_target
+from response_cache import RECOMMENDATION_CACHE_TTL_SECONDS
+from response_cache import recommendations as cached_recommendations
+from response_cache import stats as response_cache_stats
+from shared_metrics import render as render_metrics
+from spotify_clients import spotify_clients
 
 app = Flask(__name__)
 # Configure CORS to allow requests from our React app
@@ -27,24 +52,92 @@ CORS(app,
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Audio features used as recommendation targets
+TARGET_FEATURES = ('danceability', 'energy', 'valence', 'tempo', 'acousticness', 'instrumentalness')
+
+# How generate picks tracks: 'recommendations' asks Spotify for similar
+# tracks, 'local' ranks the source's own tracks by audio features
+SELECTION_MODES = ('recommendations', 'local')
+
+# Artists and genres listed by the stats endpoints
+DEFAULT_STATS_TOP = 20
+MAX_STATS_TOP = 200
+
+# Limits for /api/playlists/generate-batch
+MAX_BATCH_PROMPTS = 50
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+
+# Page size for listing all of a user's playlists, and the formats it streams
+PLAYLISTS_PAGE_SIZE = 50
+PLAYLIST_LISTING_FORMATS = ('json', 'ndjson')
+
+# Seconds between keep-alive comments on idle job event streams
+SSE_HEARTBEAT_SECONDS = 15
+
+# How long an export waits for its liked songs sync. Most syncs fetch a page
+# or two; a first or full sync is left running as a job and answered with 202.
+EXPORT_SYNC_WAIT_SECONDS = float(os.environ.get('EXPORT_SYNC_WAIT_SECONDS', 5))
+
+# Default number of tracks per cluster when k isn't given, and an upper bound
+# on k so a tiny cluster size can't create hundreds of playlists
+DEFAULT_CLUSTER_SIZE = 50
+MAX_CLUSTERS = 50
+
 # Configure LM Studio API - running locally at this URL, adjust if needed
 LM_STUDIO_API_URL = "http://localhost:1234/v1/chat/completions"
 
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    start_request_timings()
+
+@app.after_request
+def add_timing_headers(response):
+    """Expose per-stage timings as Server-Timing, and in the body with ?timings=1."""
+    timings = request_timings()
+    if timings is None or 'request_start' not in g:
+        return response
+    timings = timings + [('total', time.perf_counter() - g.request_start)]
+    response.headers['Server-Timing'] = server_timing_header(timings)
+    
+    if request.args.get('timings') and response.is_json and not response.is_streamed:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            body['timings'] = [{"stage": name, "ms": round(seconds * 1000, 1)} for name, seconds in timings]
+            response.set_data(json.dumps(body))
+    return response
+
+metrics_registry.register(Gauge(
+    'playlist_generator_jobs', 'Background jobs held by the server, by status', ['status'], job_manager.counts
+))
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for pipeline stages and outbound Spotify calls, from every worker."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/me', methods=['GET'])
 def get_current_user():
     token = get_token_from_header()
     if not token:
         return jsonify({"error": "No token provided"}), 401
     
-    sp = create_spotify_client(token)
     try:
-        return jsonify(sp.current_user())
+        return jsonify(spotify_clients.current_user(token))
     except Exception as e:
         logger.error(f"Error getting current user: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 @app.route('/api/me/playlists', methods=['GET', 'OPTIONS'])
 def get_user_playlists():
+    """List the user's playlists.
+    
+    Returns Spotify's first page unless `all=true` is given. Then every page
+    is fetched, the later ones concurrently, and streamed out as it arrives:
+    `format=ndjson` sends one playlist per line and a final summary line,
+    the default `format=json` an object with `items`, `total` and `etag`.
+    Sending that etag back in `If-None-Match` gets a 304 if nothing changed.
+    """
     # Handle preflight OPTIONS request
     if request.method == "OPTIONS":
         return handle_preflight()
@@ -54,14 +147,87 @@ def get_user_playlists():
         return jsonify({"error": "No token provided"}), 401
     
     sp = create_spotify_client(token)
+    if request.args.get('all', '').lower() in ('1', 'true'):
+        return list_all_playlists(sp)
     try:
         logger.info("Fetching user playlists")
-        playlists = sp.current_user_playlists()
+        with priority('interactive'):
+            playlists = sp.current_user_playlists()
         logger.info(f"Successfully fetched {len(playlists.get('items', []))} playlists")
         return jsonify(playlists)
     except Exception as e:
         logger.error(f"Error getting playlists: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def list_all_playlists(sp):
+    listing_format = request.args.get('format', 'json')
+    if listing_format not in PLAYLIST_LISTING_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(PLAYLIST_LISTING_FORMATS)}"}), 400
+    
+    def fetch_page(offset, limit):
+        # Pages are fetched while the response streams, outside this
+        # handler's context, so the priority is set per page
+        with priority('interactive'):
+            return sp.current_user_playlists(limit=limit, offset=offset)
+    
+    pages = iter_pages(fetch_page, PLAYLISTS_PAGE_SIZE)
+    # Items are serialized once, with sorted keys so the etag is stable
+    lines = (json.dumps(item, sort_keys=True) for page in pages for item in page['items'])
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    try:
+        if request.if_none_match:
+            # Checking the etag needs the whole listing before answering
+            with stage('fetch_playlists'):
+                lines = list(lines)
+            etag = listing_etag(lines)
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+            headers['ETag'] = f'"{etag}"'
+        else:
+            # Fetch the first page now, so a failing token is an error status
+            # rather than an error inside a 200 stream
+            first = next(lines, None)
+            lines = itertools.chain([first] if first is not None else [], lines)
+    except Exception as e:
+        logger.error(f"Error getting playlists: {str(e)}")
+        return error_response(e)
+    
+    mimetype = 'application/x-ndjson' if listing_format == 'ndjson' else 'application/json'
+    return Response(stream_playlist_listing(lines, listing_format), mimetype=mimetype, headers=headers)
+
+def listing_etag(lines):
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()[:32]
+
+def stream_playlist_listing(lines, listing_format):
+    """Serialize playlist lines as NDJSON or one JSON object, ending with the etag."""
+    digest = hashlib.sha256()
+    count = 0
+    error = None
+    if listing_format == 'json':
+        yield '{"items": ['
+    try:
+        for line in lines:
+            digest.update(line.encode())
+            digest.update(b'\n')
+            if listing_format == 'ndjson':
+                yield line + '\n'
+            else:
+                yield (',' if count else '') + line
+            count += 1
+    except Exception as e:
+        # Headers are gone already, so the error can only go in the body
+        logger.error(f"Error streaming playlists after {count}: {str(e)}")
+        error = str(e)
+    
+    summary = {"total": count, "etag": digest.hexdigest()[:32]} if error is None else {"total": count, "error": error}
+    if listing_format == 'ndjson':
+        yield json.dumps({"done": error is None, **summary}) + '\n'
+    else:
+        yield '], ' + json.dumps(summary)[1:]
 
 @app.route('/api/playlists/generate', methods=['POST', 'OPTIONS'])
 def generate_playlist_from_prompt():
@@ -73,106 +239,666 @@ def generate_playlist_from_prompt():
     if not token:
         return jsonify({"error": "No token provided"}), 401
     
+    try:
+        source_id, prompt, selection_mode, target_id = parse_generate_request(request.json)
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    sp = create_spotify_client(token)
+    with stage('profile'):
+        user_id = spotify_clients.current_user(token)['id']
+    
+    try:
+        source_name, tracks = prepare_source(sp, user_id, source_id)
+        playlist = generate_playlist(
+            sp, user_id, source_id, source_name, tracks, prompt, selection_mode, target_playlist_id=target_id
+        )
+        
+        return jsonify({
+            "status": "success",
+            "playlist": playlist
+        })
+    
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), 400
+    except PlaylistWriteError as e:
+        return playlist_write_error_response(e)
+    except Exception as e:
+        logger.error(f"Error generating playlist: {str(e)}")
+        return error_response(e)
+
+@app.route('/api/playlists/generate-batch', methods=['POST', 'OPTIONS'])
+def generate_playlists_batch():
+    """Generate one playlist per prompt from a single fetch of the source.
+    
+    Body: `sourcePlaylistId`, `prompts` (list of strings), optional
+    `selectionMode` and `parallel`. Every prompt gets its own entry in
+    `results`, so one failing prompt doesn't fail the whole batch.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
+        
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
     data = request.json
     if not data:
         return jsonify({"error": "No data provided"}), 400
     
     source_id = data.get('sourcePlaylistId')
-    prompt = data.get('prompt')
+    prompts = data.get('prompts')
     
-    if not prompt:
-        return jsonify({"error": "No prompt provided"}), 400
+    if not prompts or not isinstance(prompts, list) or not all(isinstance(p, str) and p for p in prompts):
+        return jsonify({"error": "prompts must be a non-empty list of prompts"}), 400
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return jsonify({"error": f"At most {MAX_BATCH_PROMPTS} prompts per batch"}), 400
+    
+    selection_mode = data.get('selectionMode', 'recommendations')
+    if selection_mode not in SELECTION_MODES:
+        return jsonify({"error": f"selectionMode must be one of {', '.join(SELECTION_MODES)}"}), 400
     
     sp = create_spotify_client(token)
-    user_id = sp.current_user()['id']
+    user_id = spotify_clients.current_user(token)['id']
     
     try:
-        # Get tracks from source
-        tracks = []
-        if source_id == 'liked_songs':
-            # Get all liked songs
-            results = sp.current_user_saved_tracks(limit=50)
-            tracks = [item['track'] for item in results['items']]
-            
-            while results['next']:
-                results = sp.next(results)
-                tracks.extend([item['track'] for item in results['items']])
-        else:
-            # Get all tracks from the playlist
-            results = sp.playlist_tracks(source_id)
-            tracks = [item['track'] for item in results['items']]
-            
-            while results['next']:
-                results = sp.next(results)
-                tracks.extend([item['track'] for item in results['items']])
+        source_name, tracks = prepare_source(sp, user_id, source_id)
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error loading batch source: {str(e)}")
+        return error_response(e)
+    
+    def run(prompt):
+        try:
+            playlist = generate_playlist(sp, user_id, source_id, source_name, tracks, prompt, selection_mode)
+            return {"prompt": prompt, "status": "success", "playlist": playlist}
+        except PlaylistWriteError as e:
+            return {"prompt": prompt, "status": "error", "error": str(e), "writeId": e.write_id, "playlistId": e.playlist_id}
+        except Exception as e:
+            logger.error(f"Error generating playlist for prompt {prompt!r}: {str(e)}")
+            return {"prompt": prompt, "status": "error", "error": str(e)}
+    
+    if data.get('parallel', True) and len(prompts) > 1:
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(prompts))) as pool:
+            # Each task runs in a copy of this request's context so its
+            # stage timings still land in the response
+            futures = [pool.submit(contextvars.copy_context().run, run, prompt) for prompt in prompts]
+            results = [future.result() for future in futures]
+    else:
+        results = [run(prompt) for prompt in prompts]
+    
+    succeeded = sum(1 for result in results if result["status"] == "success")
+    if succeeded == len(results):
+        status = "success"
+    elif succeeded:
+        status = "partial"
+    else:
+        status = "error"
+    
+    return jsonify({
+        "status": status,
+        "source": source_name,
+        "results": results
+    })
+
+@app.route('/api/playlists/writes/<write_id>/resume', methods=['POST', 'OPTIONS'])
+def resume_playlist_write(write_id):
+    """Finish adding tracks to a playlist whose write was interrupted."""
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
+        
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    sp = create_spotify_client(token)
+    user_id = spotify_clients.current_user(token)['id']
+    
+    try:
+        snapshot_id = resume_write(sp, user_id, write_id)
+        return jsonify({"status": "success", "writeId": write_id, "snapshotId": snapshot_id})
+    except KeyError:
+        return jsonify({"error": "Write not found"}), 404
+    except PlaylistWriteError as e:
+        return playlist_write_error_response(e)
+    except Exception as e:
+        logger.error(f"Error resuming playlist write: {str(e)}")
+        return error_response(e)
+
+def error_response(error):
+    """The response for an unexpected error in a handler.
+    
+    Spotify rate limiting becomes a 429 with Retry-After, so clients can
+    back off instead of treating it as a server failure. Anything else is
+    a 500.
+    """
+    if isinstance(error, SpotifyException) and error.http_status == 429:
+        retry_after = (error.headers or {}).get('Retry-After')
+        response = jsonify({
+            "error": "Spotify rate limit reached, try again later",
+            "retryAfter": int(retry_after) if str(retry_after).isdigit() else None
+        })
+        response.status_code = 429
+        if retry_after:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+    return jsonify({"error": str(error)}), 500
+
+@app.errorhandler(SpotifyException)
+def handle_spotify_exception(error):
+    logger.error(f"Unhandled Spotify error: {str(error)}")
+    return error_response(error)
+
+def playlist_write_error_response(error):
+    """Report a partial playlist write with what's needed to resume it."""
+    return jsonify({
+        "error": str(error),
+        "playlistId": error.playlist_id,
+        "writeId": error.write_id
+    }), 500
+
+@app.route('/api/jobs/generate', methods=['POST', 'OPTIONS'])
+def submit_generate_job():
+    """Queue a generate request and return its job id right away.
+    
+    Takes the same body as /api/playlists/generate. Poll /api/jobs/<id> or
+    stream /api/jobs/<id>/events for progress; DELETE the job to cancel it.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
+        
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    try:
+        source_id, prompt, selection_mode, target_id = parse_generate_request(request.json)
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    sp = create_spotify_client(token)
+    user_id = spotify_clients.current_user(token)['id']
+    
+    def run(job):
+        source_name, tracks = prepare_source(sp, user_id, source_id, progress=job.update)
+        return generate_playlist(
+            sp, user_id, source_id, source_name, tracks, prompt, selection_mode,
+            target_playlist_id=target_id, progress=job.update
+        )
+    
+    try:
+        job = job_manager.submit('generate', token_owner(token), run)
+    except JobQueueFull as e:
+        logger.warning(f"Rejecting generate job: {str(e)}")
+        return jsonify({"error": "Too many jobs queued, try again later"}), 503
+    
+    return jsonify({"status": "queued", "job": job.to_dict()}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'DELETE', 'OPTIONS'])
+def get_job(job_id):
+    """Report a job's status and progress, or cancel it with DELETE."""
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
         
-        logger.info(f"Retrieved {len(tracks)} tracks")
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    job = job_manager.get(job_id)
+    if not job or job.owner != token_owner(token):
+        return jsonify({"error": "Job not found"}), 404
+    
+    if request.method == 'DELETE' and not job.finished:
+        logger.info(f"Cancelling job {job_id}")
+        job.cancel()
+    
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET', 'OPTIONS'])
+def stream_job_events(job_id):
+    """Stream a job's progress as Server-Sent Events until it finishes.
+    
+    Sends a `progress` event with the job state on every change and a final
+    `done` event. Comment lines keep idle connections open.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
         
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    job = job_manager.get(job_id)
+    if not job or job.owner != token_owner(token):
+        return jsonify({"error": "Job not found"}), 404
+    
+    def events():
+        version = None
+        while True:
+            current = job.version
+            if current != version:
+                version = current
+                state = job.to_dict()
+                finished = state['status'] in FINISHED_STATUSES
+                yield f"event: {'done' if finished else 'progress'}\ndata: {json.dumps(state)}\n\n"
+                if finished:
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            job.wait_for_change(version, SSE_HEARTBEAT_SECONDS)
+    
+    return Response(
+        events(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/library/cluster', methods=['POST', 'OPTIONS'])
+def cluster_library_tracks():
+    """Split a library into mood clusters, optionally saving each as a playlist.
+    
+    Body: `sourcePlaylistId` (defaults to liked songs), either `k` or
+    `clusterSize` (target tracks per cluster), and `createPlaylists`.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
+        
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    data = request.json or {}
+    source_id = data.get('sourcePlaylistId', 'liked_songs')
+    create_playlists = bool(data.get('createPlaylists', False))
+    
+    try:
+        k = int(data['k']) if data.get('k') is not None else None
+        cluster_size = int(data.get('clusterSize') or DEFAULT_CLUSTER_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({"error": "k and clusterSize must be integers"}), 400
+    if (k is not None and k < 1) or cluster_size < 1:
+        return jsonify({"error": "k and clusterSize must be positive"}), 400
+    
+    sp = create_spotify_client(token)
+    user_id = spotify_clients.current_user(token)['id']
+    
+    try:
+        source_name, tracks = load_source_tracks(sp, user_id, source_id)
         if len(tracks) == 0:
             return jsonify({"error": "No tracks found in the source playlist"}), 400
         
-        # Select tracks based on the prompt
-        selected_tracks = select_tracks_with_local_llm(tracks, prompt, sp)
+        track_ids = [track.id for track in tracks]
+        with priority('background'):
+            feature_store.ensure(sp, track_ids)
+        features = feature_store.rows(track_ids)
         
-        if len(selected_tracks) == 0:
-            return jsonify({"error": "No tracks match the prompt criteria"}), 400
+        if k is None:
+            k = -(-len(tracks) // cluster_size)  # Round up
+        k = min(k, MAX_CLUSTERS)
         
-        # Get AI-generated metadata for the playlist
-        metadata = describe_playlist(selected_tracks, prompt)
+        clusters, unclustered = cluster_library(features, k)
+        logger.info(f"Clustered {len(tracks)} tracks into {len(clusters)} clusters")
         
-        # Create a new playlist with AI-generated name and description
-        source_name = "Liked Songs" if source_id == 'liked_songs' else sp.playlist(source_id)['name']
+        results = []
+        # (result, (playlist_id, uris)) for each playlist created
+        writes = []
+        for number, cluster in enumerate(clusters, start=1):
+            label = cluster_label(cluster['keywords'], cluster['genres'], number)
+            track_uris = [tracks[row].uri for row in cluster['rows']]
+            result = {
+                "label": label,
+                "keywords": cluster['keywords'],
+                "genres": cluster['genres'],
+                "centroid": cluster['centroid'],
+                "tracks": len(track_uris),
+                "trackIds": [tracks[row].id for row in cluster['rows']]
+            }
+            
+            if create_playlists:
+                description = playlist_description(f"Cluster of {source_name}: {', '.join(cluster['keywords']) or 'mixed'}")
+                try:
+                    new_playlist = sp.user_playlist_create(
+                        user=user_id,
+                        name=sanitize_playlist_name(label, f"Cluster {number}"),
+                        public=False,
+                        description=description
+                    )
+                except Exception as e:
+                    # Report it with this cluster; the playlists already
+                    # created are still filled below
+                    logger.error(f"Error creating playlist for cluster {number}: {str(e)}")
+                    result["playlist"] = {"name": label, "error": str(e)}
+                else:
+                    result["playlist"] = {"id": new_playlist['id'], "name": label}
+                    writes.append((result, (new_playlist['id'], track_uris)))
+            
+            results.append(result)
         
-        # Use a simple description instead of the AI-generated one
-        description = f"Inspired by: {prompt} | Source: {source_name}"
-        # Ensure description is within Spotify's limit and properly formatted
-        description = description.strip()[:300]  # Spotify has a 300 character limit
-        # Final sanitization pass
-        description = description.encode('ascii', 'ignore').decode()  # Remove non-ASCII characters
+        # Fill the new playlists concurrently; a failed write is reported
+        # with its write id instead of failing the whole request
+        outcomes = write_playlists(sp, user_id, [write for _, write in writes])
+        for (result, _), outcome in zip(writes, outcomes):
+            if "error" in outcome:
+                result["playlist"].update(error=outcome["error"], writeId=outcome["writeId"])
         
-        # Sanitize the playlist name
-        playlist_name = metadata.get('name', f"AI Playlist: {prompt}")
-        # Remove any problematic characters and normalize whitespace
-        playlist_name = re.sub(r'[^\w\s.,!?-]', '', playlist_name)  # Only allow basic punctuation
-        playlist_name = ' '.join(playlist_name.split())  # Normalize whitespace
-        # Ensure name is not empty and has a reasonable length
-        if not playlist_name or len(playlist_name.strip()) == 0:
-            playlist_name = f"AI Playlist: {prompt}"
-        playlist_name = playlist_name[:100]  # Limit length
+        failed = any("error" in result.get("playlist", {}) for result in results)
+        return jsonify({
+            "status": "partial" if failed else "success",
+            "source": source_name,
+            "clusters": results,
+            "unclustered": len(unclustered)
+        })
+            
+    except Exception as e:
+        logger.error(f"Error clustering library: {str(e)}")
+        return error_response(e)
+
+@app.route('/api/library/tracks', methods=['GET', 'OPTIONS'])
+def export_library_tracks():
+    """Stream the user's liked songs as NDJSON or CSV.
+    
+    Query: `format` (ndjson or csv), `fields` (comma-separated, audio feature
+    names allowed), `features=true` to add every audio feature, and
+    `sync=false` to skip bringing the cache up to date first. The sync runs
+    as a job; if it takes longer than EXPORT_SYNC_WAIT_SECONDS the response
+    is a 202 with the job, to poll before asking again. Rows are read from
+    the library cache in batches, so memory doesn't grow with the library.
+    Features come from the feature store only and are null for tracks it
+    doesn't have yet.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
+        
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        fields = parse_fields(request.args.get('fields'), request.args.get('features', '').lower() in ('1', 'true'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    sp = create_spotify_client(token)
+    try:
+        user_id = spotify_clients.current_user(token)['id']
+    except Exception as e:
+        logger.error(f"Error loading user for export: {str(e)}")
+        return error_response(e)
+    
+    if request.args.get('sync', 'true').lower() not in ('0', 'false'):
+        def run(job):
+            with stage('fetch_tracks'), priority('background'):
+                update_liked_songs(sp, user_id, progress=job.update)
+        
+        try:
+            job = job_manager.submit('sync_liked_songs', token_owner(token), run)
+        except JobQueueFull as e:
+            logger.warning(f"Rejecting export sync job: {str(e)}")
+            return jsonify({"error": "Too many jobs queued, try again later"}), 503
+        
+        deadline = time.monotonic() + EXPORT_SYNC_WAIT_SECONDS
+        version = job.version
+        while not job.finished and time.monotonic() < deadline:
+            version = job.wait_for_change(version, deadline - time.monotonic())
+        if not job.finished:
+            logger.info(f"Export for {user_id} waiting on sync job {job.id}")
+            return jsonify({"status": "syncing", "job": job.to_dict()}), 202, {'Location': f"/api/jobs/{job.id}"}
+        if job.status != 'succeeded':
+            logger.error(f"Error syncing library for export: {job.error}")
+            return jsonify({"error": job.error or f"Library sync {job.status}"}), 500
+    
+    rows = export_rows(user_id, fields)
+    if export_format == 'csv':
+        return Response(
+            to_csv(fields, rows),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="liked-songs.csv"', 'X-Accel-Buffering': 'no'}
+        )
+    return Response(to_ndjson(fields, rows), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/library/stats', methods=['GET', 'OPTIONS'])
+def get_library_stats():
+    """Feature distributions, decades, top artists and genres of the liked songs."""
+    return source_stats_response('liked_songs')
+
+@app.route('/api/playlists/<playlist_id>/stats', methods=['GET', 'OPTIONS'])
+def get_playlist_stats(playlist_id):
+    """The same stats as /api/library/stats, for one playlist."""
+    return source_stats_response(playlist_id)
+
+def source_stats_response(source_id):
+    """Serve stats for a source, syncing it first.
+    
+    Query: `top`, how many artists and genres to list (default 20). Stats
+    are stored per source and only tracks added since the last request are
+    processed, so repeat requests cost a sync and no recomputation.
+    """
+    # Handle preflight OPTIONS request
+    if request.method == "OPTIONS":
+        return handle_preflight()
         
+    token = get_token_from_header()
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+    
+    try:
+        top = int(request.args.get('top', DEFAULT_STATS_TOP))
+    except ValueError:
+        return jsonify({"error": "top must be an integer"}), 400
+    if not 1 <= top <= MAX_STATS_TOP:
+        return jsonify({"error": f"top must be between 1 and {MAX_STATS_TOP}"}), 400
+    
+    sp = create_spotify_client(token)
+    try:
+        user_id = spotify_clients.current_user(token)['id']
+        with stage('fetch_tracks'):
+            source_name, tracks = load_source_tracks(sp, user_id, source_id)
+        with stage('stats'), priority('background'):
+            stats = library_stats(sp, user_id, source_id, tracks)
+    except Exception as e:
+        logger.error(f"Error computing stats for {source_id}: {str(e)}")
+        return error_response(e)
+    
+    return jsonify({"source": {"id": source_id, "name": source_name}, **stats.to_dict(top)})
+
+def cluster_label(keywords, genres, number):
+    """Name a cluster from its keywords, e.g. "Energetic & Happy (Dance)"."""
+    if not keywords:
+        return f"Cluster {number}"
+    label = " & ".join(word.title() for word in keywords)
+    if genres:
+        label = f"{label} ({genres[0].title()})"
+    return label
+
+class GenerationError(Exception):
+    """A generate request that can't be satisfied, reported as a 400."""
+
+def parse_generate_request(data):
+    """Validate a generate body.
+    
+    Returns (source id, prompt, selection mode, target playlist id), where
+    the target is None unless an existing playlist should be updated.
+    """
+    if not data:
+        raise GenerationError("No data provided")
+    
+    source_id = data.get('sourcePlaylistId')
+    prompt = data.get('prompt')
+    
+    if not prompt:
+        raise GenerationError("No prompt provided")
+    
+    selection_mode = data.get('selectionMode', 'recommendations')
+    if selection_mode not in SELECTION_MODES:
+        raise GenerationError(f"selectionMode must be one of {', '.join(SELECTION_MODES)}")
+    
+    target_id = data.get('targetPlaylistId')
+    if target_id is not None and (not isinstance(target_id, str) or not target_id):
+        raise GenerationError("targetPlaylistId must be a playlist id")
+    
+    return source_id, prompt, selection_mode, target_id
+
+def prepare_source(sp, user_id, source_id, progress=None):
+    """Load a source's tracks and make sure their audio features are stored.
+    
+    This is the part of generation shared by every prompt run against the
+    same source. `progress(stage, **counts)` is called as work completes.
+    """
+    with stage('fetch_tracks'):
+        source_name, tracks = load_source_tracks(sp, user_id, source_id, progress)
+    
+    logger.info(f"Retrieved {len(tracks)} tracks")
+    
+    if len(tracks) == 0:
+        raise GenerationError("No tracks found in the source playlist")
+    
+    # Make sure the feature store covers the whole source; only tracks
+    # it hasn't seen before are fetched
+    try:
+        with stage('audio_features'):
+            with priority('background'):
+                feature_store.ensure(sp, [track.id for track in tracks], progress)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting audio features: {str(e)}")
+    
+    return source_name, tracks
+
+def generate_playlist(sp, user_id, source_id, source_name, tracks, prompt, selection_mode,
+                      target_playlist_id=None, progress=None):
+    """Select tracks for a prompt and save them as a new playlist.
+    
+    With `target_playlist_id` the selection replaces the contents of that
+    playlist instead, changing only what differs.
+    """
+    genre_matches = find_genre_matches(sp, user_id, source_id, tracks, prompt, progress)
+    
+    # Select tracks based on the prompt
+    with stage('select'):
+        if selection_mode == 'local':
+            selected_tracks = select_tracks_locally(tracks, prompt, genre_matches=genre_matches)
+        else:
+            selected_tracks = select_tracks_with_local_llm(tracks, prompt, sp, genre_matches=genre_matches)
+    
+    if len(selected_tracks) == 0:
+        raise GenerationError("No tracks match the prompt criteria")
+    if progress:
+        progress('selecting', selected=len(selected_tracks))
+    
+    # Get AI-generated metadata for the playlist
+    metadata = describe_playlist(selected_tracks, prompt)
+    
+    if target_playlist_id:
+        with stage('update_playlist'):
+            update = update_playlist(sp, target_playlist_id, [track.uri for track in selected_tracks], progress)
+        # The playlist is refreshed, not renamed, so it keeps its own name
+        return {
+            "id": target_playlist_id,
+            "name": update.pop('name'),
+            "tracks": len(selected_tracks),
+            "prompt": prompt,
+            "update": update
+        }
+    
+    # Create a new playlist with AI-generated name and description
+    # Use a simple description instead of the AI-generated one
+    description = playlist_description(f"Inspired by: {prompt} | Source: {source_name}")
+    playlist_name = sanitize_playlist_name(metadata.get('name', f"AI Playlist: {prompt}"), f"AI Playlist: {prompt}")
+    
+    new_playlist = create_playlist_with_tracks(
+        sp, user_id, playlist_name, description, [track.uri for track in selected_tracks], progress
+    )
+    
+    return {
+        "id": new_playlist['id'],
+        "name": metadata.get('name', f"AI Playlist: {prompt}"),
+        "tracks": len(selected_tracks),
+        "prompt": prompt
+    }
+
+def find_genre_matches(sp, user_id, source_id, tracks, prompt, progress=None):
+    """Source tracks whose artists play a genre the prompt names, or None.
+    
+    Uses the source's genre index, so only artists not seen before cost an
+    API call. A failed lookup falls back to selecting without genres.
+    """
+    genres = parse_prompt(prompt).named_genres
+    if not genres:
+        return None
+    try:
+        with stage('genres'), priority('background'):
+            matches = genre_index(sp, user_id, source_id, tracks, progress).lookup(genres)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logger.warning(f"Genre lookup failed, selecting without it: {str(e)}")
+        return None
+    logger.info(f"{len(matches)} source tracks match genres {list(genres)}")
+    return matches
+
+def load_source_tracks(sp, user_id, source_id, progress=None):
+    """Return (source name, tracks) for liked songs or a playlist.
+    
+    Tracks are served from the local library cache, only fetching what
+    changed since the last sync. Syncs yield to interactive Spotify calls.
+    """
+    with priority('background'):
+        if source_id == 'liked_songs':
+            return "Liked Songs", sync_liked_songs(sp, user_id, progress)
+        return sync_playlist(sp, user_id, source_id, progress)
+
+def playlist_description(description):
+    """Make a description safe to send to Spotify."""
+    # Ensure description is within Spotify's limit and properly formatted
+    description = description.strip()[:300]  # Spotify has a 300 character limit
+    # Final sanitization pass
+    return description.encode('ascii', 'ignore').decode()  # Remove non-ASCII characters
+
+def sanitize_playlist_name(playlist_name, fallback):
+    """Make a playlist name safe to send to Spotify."""
+    # Remove any problematic characters and normalize whitespace
+    playlist_name = re.sub(r'[^\w\s.,!?-]', '', playlist_name)  # Only allow basic punctuation
+    playlist_name = ' '.join(playlist_name.split())  # Normalize whitespace
+    # Ensure name is not empty and has a reasonable length
+    if not playlist_name or len(playlist_name.strip()) == 0:
+        playlist_name = fallback
+    return playlist_name[:100]  # Limit length
+
+def create_playlist_with_tracks(sp, user_id, name, description, track_uris, progress=None):
+    """Create a private playlist and add the given tracks to it."""
+    with stage('create_playlist'):
         new_playlist = sp.user_playlist_create(
             user=user_id,
-            name=playlist_name,
+            name=name,
             public=False,
             description=description
         )
-        
-        # Add tracks to the playlist
-        track_uris = [track['uri'] for track in selected_tracks]
-        for i in range(0, len(track_uris), 100):  # Spotify has a limit of 100 tracks per request
-            batch = track_uris[i:i+100]
-            sp.playlist_add_items(new_playlist['id'], batch)
-        
-        return jsonify({
-            "status": "success",
-            "playlist": {
-                "id": new_playlist['id'],
-                "name": metadata.get('name', f"AI Playlist: {prompt}"),
-                "tracks": len(selected_tracks),
-                "prompt": prompt
-            }
-        })
-            
-    except Exception as e:
-        logger.error(f"Error generating playlist: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    
+    # Add tracks to the playlist in resumable, position-aware batches
+    with stage('add_items'):
+        write_playlist(sp, user_id, new_playlist['id'], track_uris, progress=progress)
+    
+    return new_playlist
 
-def select_tracks_with_local_llm(tracks, prompt, sp):
+def select_tracks_with_local_llm(tracks, prompt, sp, genre_matches=None):
     """Select tracks based on user prompt using Spotify's recommendation API.
     
     This function uses Spotify's recommendation engine to find tracks that match the prompt.
     It extracts musical attributes and genres from the prompt and uses them as parameters
-    for Spotify's recommendation API.
+    for Spotify's recommendation API. Source tracks in `genre_matches` are preferred
+    for the share of the playlist taken from the source.
     """
     try:
         logger.info(f"Using Spotify recommendations to select tracks for prompt: {prompt}")
@@ -184,24 +910,25 @@ def select_tracks_with_local_llm(tracks, prompt, sp):
         # Get seed tracks from the source playlist
         # We'll use these as a starting point for recommendations
         import random
-        # Randomly select 5 tracks from the source to use as seeds
+        # Randomly select 5 tracks from the source to use as seeds. The draw is
+        # seeded by the source and changes once per cache lifetime, so repeated
+        # or similar prompts ask for the same recommendations and share them.
+        seed_random = random.Random(
+            f"{len(tracks)}:{tracks[0].id if tracks else ''}:{int(time.time() // RECOMMENDATION_CACHE_TTL_SECONDS)}"
+        )
         if len(tracks) > 5:
-            seed_track_candidates = random.sample(tracks, min(20, len(tracks)))
+            seed_track_candidates = seed_random.sample(tracks, min(20, len(tracks)))
         else:
-            seed_track_candidates = tracks
+            seed_track_candidates = list(tracks)
             
         # Sort by popularity to get more relevant recommendations
-        seed_track_candidates.sort(key=lambda x: x.get('popularity', 0), reverse=True)
-        seed_tracks = [t['id'] for t in seed_track_candidates[:5]]  # Use top 5 as seeds
+        seed_track_candidates.sort(key=lambda x: x.popularity, reverse=True)
+        seed_tracks = [t.id for t in seed_track_candidates[:5]]  # Use top 5 as seeds
         
         # Get audio features for seed tracks to understand their characteristics
-        audio_features = []
-        if seed_tracks:
-            try:
-                audio_features = sp.audio_features(seed_tracks)
-                logger.info(f"Retrieved audio features for {len(audio_features)} seed tracks")
-            except Exception as e:
-                logger.error(f"Error getting audio features: {str(e)}")
+        with stage('seed_features'):
+            audio_features = feature_store.rows(seed_tracks)
+        logger.info(f"Retrieved audio features for {len(audio_features)} seed tracks")
         
         # Calculate average audio features to use as targets
         target_features = calculate_average_features(audio_features)
@@ -221,17 +948,18 @@ def select_tracks_with_local_llm(tracks, prompt, sp):
         if target_features:
             recommendations_params.update(target_features)
         
-        # Remove None values
-        recommendations_params = {k: v for k, v in recommendations_params.items() if v is not None}
-        
         logger.info(f"Getting recommendations with params: {recommendations_params}")
-        recommendations = sp.recommendations(**recommendations_params)['tracks']
+        with stage('recommendations'):
+            # None values are dropped and targets quantized by the cache
+            recommendations = cached_recommendations(sp, **recommendations_params)
         logger.info(f"Retrieved {len(recommendations)} recommendations from Spotify")
         
         # Combine some source tracks with recommendations for a balanced playlist
         # We'll take 30% from original tracks and 70% from recommendations
         num_source_tracks = min(int(len(tracks) * 0.3), 20)  # At most 20 source tracks
-        source_selection = random.sample(tracks, min(num_source_tracks, len(tracks)))
+        source_selection = random.sample(genre_matches, min(num_source_tracks, len(genre_matches))) if genre_matches else []
+        if len(source_selection) < num_source_tracks:
+            source_selection += random.sample(tracks, min(num_source_tracks - len(source_selection), len(tracks)))
         
         # Combine tracks, prioritizing recommendations
         selected_tracks = recommendations + source_selection
@@ -240,8 +968,8 @@ def select_tracks_with_local_llm(tracks, prompt, sp):
         unique_tracks = []
         track_ids = set()
         for track in selected_tracks:
-            if track['id'] not in track_ids:
-                track_ids.add(track['id'])
+            if track.id not in track_ids:
+                track_ids.add(track.id)
                 unique_tracks.append(track)
         
         # Ensure we have a reasonable number of tracks
@@ -258,210 +986,79 @@ def select_tracks_with_local_llm(tracks, prompt, sp):
         logger.warning("Using fallback selection method with a random sample from source")
         return random.sample(tracks, min(20, len(tracks)))
 
+def select_tracks_locally(tracks, prompt, limit=50, genre_matches=None):
+    """Select the source tracks whose audio features best fit the prompt.
+    
+    The target is the source's average features adjusted by the prompt
+    keywords, the same targets the recommendation path sends to Spotify.
+    Every source track is then scored against it in one matrix operation,
+    so no network call is made and the same prompt always gives the same
+    playlist. Features the prompt moved count double. Tracks in
+    `genre_matches` are ranked first; the rest only fill remaining places.
+    """
+    features = feature_store.rows([track.id for track in tracks])
+    baseline = calculate_average_features(features)
+    target_features = adjust_features_from_prompt(prompt, dict(baseline))
+    
+    weights = {
+        name: weight * 2 if target_features.get(f'target_{name}') != baseline.get(f'target_{name}') else weight
+        for name, weight in FEATURE_WEIGHTS.items()
+    }
+    with stage('rank'):
+        selected = []
+        if genre_matches:
+            match_features = feature_store.rows([track.id for track in genre_matches])
+            selected = [genre_matches[row] for row in rank_by_target(match_features, target_features, limit, weights)]
+        if len(selected) < limit:
+            chosen = {track.id for track in selected}
+            ranked = rank_by_target(features, target_features, limit + len(selected), weights)
+            rest = [tracks[row] for row in ranked if tracks[row].id not in chosen]
+            selected += rest[:limit - len(selected)]
+    
+    logger.info(f"Selected {len(selected)} of {len(tracks)} tracks locally for prompt: {prompt}")
+    return selected
+
 def adjust_features_from_prompt(prompt, target_features):
     """Adjust audio feature targets based on keywords in the prompt."""
-    normalized_prompt = prompt.lower()
-    
-    # Energy adjustments
-    if any(word in normalized_prompt for word in ['energetic', 'upbeat', 'party', 'workout', 'intense', 'dance', 'dancing']):
-        target_features['target_energy'] = min(target_features.get('target_energy', 0) + 0.3, 1.0)
-    elif any(word in normalized_prompt for word in ['calm', 'relaxing', 'chill', 'peaceful', 'sleep', 'ambient', 'meditation']):
-        target_features['target_energy'] = max(target_features.get('target_energy', 0) - 0.3, 0.0)
-    
-    # Danceability adjustments
-    if any(word in normalized_prompt for word in ['dance', 'dancing', 'party', 'groove', 'groovy', 'funky']):
-        target_features['target_danceability'] = min(target_features.get('target_danceability', 0) + 0.3, 1.0)
-    
-    # Valence (positivity) adjustments
-    if any(word in normalized_prompt for word in ['happy', 'upbeat', 'positive', 'cheerful', 'joy']):
-        target_features['target_valence'] = min(target_features.get('target_valence', 0) + 0.3, 1.0)
-    elif any(word in normalized_prompt for word in ['sad', 'melancholy', 'depressing', 'somber', 'dark']):
-        target_features['target_valence'] = max(target_features.get('target_valence', 0) - 0.3, 0.0)
-    
-    # Acousticness adjustments
-    if any(word in normalized_prompt for word in ['acoustic', 'unplugged', 'folk', 'singer-songwriter']):
-        target_features['target_acousticness'] = min(target_features.get('target_acousticness', 0) + 0.3, 1.0)
-    elif any(word in normalized_prompt for word in ['electronic', 'synth', 'edm', 'produced']):
-        target_features['target_acousticness'] = max(target_features.get('target_acousticness', 0) - 0.3, 0.0)
-    
-    # Instrumentalness adjustments
-    if any(word in normalized_prompt for word in ['instrumental', 'no vocals', 'no singing', 'background']):
-        target_features['target_instrumentalness'] = min(target_features.get('target_instrumentalness', 0) + 0.3, 1.0)
-    elif any(word in normalized_prompt for word in ['vocals', 'singing', 'vocal', 'lyrics']):
-        target_features['target_instrumentalness'] = max(target_features.get('target_instrumentalness', 0) - 0.3, 0.0)
-    
-    # Tempo adjustments
-    if any(word in normalized_prompt for word in ['fast', 'upbeat', 'energetic', 'workout']):
-        target_features['target_tempo'] = target_features.get('target_tempo', 120) + 20
-    elif any(word in normalized_prompt for word in ['slow', 'relaxing', 'chill', 'ballad']):
-        target_features['target_tempo'] = max(target_features.get('target_tempo', 120) - 20, 60)
+    for feature, delta in parse_prompt(prompt).feature_deltas.items():
+        key = f'target_{feature}'
+        if feature == 'tempo':
+            # Tempo is in BPM rather than 0-1
+            target_features[key] = max(target_features.get(key, 120) + delta, 60)
+        else:
+            target_features[key] = min(max(target_features.get(key, 0) + delta, 0.0), 1.0)
     
     return target_features
 
 def extract_genres_from_prompt(prompt):
     """Extract potential genres from the user's prompt.
     
-    This is a simple implementation that looks for common genre keywords.
-    A more sophisticated approach could use an LLM or a genre classification model.
+    Genres named in the prompt come first; if there are none they are
+    inferred from mood and activity keywords. See prompt_parser.
     """
-    # List of common music genres
-    common_genres = [
-        'rock', 'pop', 'hip hop', 'rap', 'jazz', 'blues', 'country', 'metal',
-        'folk', 'electronic', 'dance', 'r&b', 'soul', 'funk', 'disco', 'classical',
-        'reggae', 'punk', 'indie', 'alternative', 'techno', 'house', 'ambient',
-        'edm', 'trap', 'lo-fi', 'instrumental', 'acoustic', 'soundtrack',
-        # Add more specific subgenres for better matching
-        'indie rock', 'indie pop', 'dream pop', 'synthwave', 'vaporwave',
-        'post-rock', 'shoegaze', 'chillwave', 'trip hop', 'downtempo',
-        'deep house', 'tech house', 'progressive house', 'electro swing',
-        'nu jazz', 'acid jazz', 'smooth jazz', 'bebop', 'hard bop',
-        'alt rock', 'grunge', 'post-punk', 'new wave', 'synth-pop',
-        'bedroom pop', 'hyperpop', 'alt-pop', 'art pop', 'baroque pop',
-        'alt-country', 'americana', 'bluegrass', 'folk rock', 'singer-songwriter'
-    ]
-    
-    # Normalize the prompt
-    normalized_prompt = prompt.lower()
-    
-    # Find genres in the prompt
-    found_genres = [genre for genre in common_genres if genre in normalized_prompt]
-    
-    # If no genres found, try to infer from other keywords
-    if not found_genres:
-        # Map keywords to potential genres
-        keyword_to_genre = {
-            # Moods
-            'energetic': 'dance',
-            'party': 'pop',
-            'workout': 'electronic',
-            'study': 'ambient',
-            'relax': 'chill',
-            'relaxing': 'chill',
-            'calm': 'ambient',
-            'peaceful': 'ambient',
-            'sad': 'blues',
-            'melancholy': 'indie',
-            'happy': 'pop',
-            'upbeat': 'pop',
-            'angry': 'rock',
-            'intense': 'metal',
-            'romantic': 'r&b',
-            'sensual': 'r&b',
-            'focus': 'instrumental',
-            'sleep': 'ambient',
-            'dreamy': 'dream pop',
-            'nostalgic': 'indie',
-            'retro': 'synthwave',
-            
-            # Activities
-            'driving': 'rock',
-            'road trip': 'rock',
-            'dinner': 'jazz',
-            'morning': 'pop',
-            'night': 'electronic',
-            'late night': 'downtempo',
-            'dancing': 'dance',
-            'running': 'electronic',
-            'gym': 'hip hop',
-            'coding': 'lo-fi',
-            'reading': 'classical',
-            'meditation': 'ambient',
-            'yoga': 'ambient',
-            'beach': 'reggae',
-            'summer': 'pop',
-            'winter': 'indie',
-            'autumn': 'folk',
-            'spring': 'indie pop',
-            'rain': 'ambient',
-            'sunset': 'chill',
-            'sunrise': 'ambient',
-            
-            # Decades
-            '80s': 'synthwave',
-            '90s': 'alternative',
-            '70s': 'rock',
-            '60s': 'rock',
-            '2000s': 'pop',
-            
-            # Descriptors
-            'chill': 'lo-fi',
-            'smooth': 'r&b',
-            'heavy': 'metal',
-            'soft': 'acoustic',
-            'acoustic': 'acoustic',
-            'instrumental': 'instrumental',
-            'vocal': 'pop',
-            'electronic': 'electronic',
-            'experimental': 'alternative',
-            'cinematic': 'soundtrack',
-            'epic': 'soundtrack',
-            'atmospheric': 'ambient',
-            'groovy': 'funk',
-            'funky': 'funk',
-            'soulful': 'soul',
-            'jazzy': 'jazz',
-            'bluesy': 'blues',
-            'folky': 'folk',
-            'indie': 'indie',
-            'alternative': 'alternative',
-            'punk': 'punk',
-            'rock': 'rock',
-            'pop': 'pop',
-            'hip hop': 'hip hop',
-            'rap': 'rap',
-            'classical': 'classical',
-            'orchestral': 'classical'
-        }
-        
-        for keyword, genre in keyword_to_genre.items():
-            if keyword in normalized_prompt:
-                found_genres.append(genre)
-    
-    # Remove duplicates while preserving order
-    unique_genres = []
-    for genre in found_genres:
-        if genre not in unique_genres:
-            unique_genres.append(genre)
-    
-    return unique_genres
+    return list(parse_prompt(prompt).genres)
 
 def calculate_average_features(audio_features):
-    """Calculate average audio features to use as targets for recommendations."""
-    if not audio_features or not all(audio_features):
-        return {}
+    """Calculate average audio features to use as targets for recommendations.
     
-    # Features to average and use as targets
-    target_features = {
-        'target_danceability': 0,
-        'target_energy': 0,
-        'target_valence': 0,  # Musical positiveness
-        'target_tempo': 0,
-        'target_acousticness': 0,
-        'target_instrumentalness': 0
-    }
+    `audio_features` is a matrix of feature store rows; tracks without
+    features are NaN rows and are left out of the average.
+    """
+    if audio_features is None or len(audio_features) == 0:
+        return {}
     
-    valid_features = [f for f in audio_features if f is not None]
-    if not valid_features:
+    valid_features = audio_features[~np.isnan(audio_features).all(axis=1)]
+    if len(valid_features) == 0:
         return {}
     
-    count = len(valid_features)
-    
-    # Calculate averages
-    for feature in valid_features:
-        if 'danceability' in feature:
-            target_features['target_danceability'] += feature['danceability'] / count
-        if 'energy' in feature:
-            target_features['target_energy'] += feature['energy'] / count
-        if 'valence' in feature:
-            target_features['target_valence'] += feature['valence'] / count
-        if 'tempo' in feature:
-            target_features['target_tempo'] += feature['tempo'] / count
-        if 'acousticness' in feature:
-            target_features['target_acousticness'] += feature['acousticness'] / count
-        if 'instrumentalness' in feature:
-            target_features['target_instrumentalness'] += feature['instrumentalness'] / count
+    averages = np.nanmean(valid_features, axis=0)
     
-    return target_features
+    # Features to average and use as targets
+    return {
+        f'target_{name}': float(averages[COLUMN_INDEX[name]])
+        for name in TARGET_FEATURES
+        if not np.isnan(averages[COLUMN_INDEX[name]])
+    }
 
 def handle_preflight():
     """Handle preflight OPTIONS requests."""
@@ -478,6 +1075,10 @@ def handle_preflight():
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
+def token_owner(token):
+    """Identify who created a job without keeping their token around."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def get_token_from_header():
     auth_header = request.headers.get('Authorization')
     if not auth_header:
@@ -493,11 +1094,15 @@ def get_token_from_header():
     return parts[1]
 
 def create_spotify_client(token):
-    return spotipy.Spotify(auth=token)
+    return spotify_clients.client(token)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "ok", "message": "Backend is running"}), 200
+    return jsonify({
+        "status": "ok",
+        "message": "Backend is running",
+        "caches": {**response_cache_stats(), **spotify_clients.stats()}
+    }), 200
 
 # Remove the LLM health check endpoint since we're not using LLM anymore
 # @app.route('/api/llm/health', methods=['GET'])
@@ -547,5 +1152,8 @@ def describe_playlist(selected_tracks, prompt):
     return {"name": playlist_name}
 
 if __name__ == '__main__':
-    logger.info("Starting Playlist Generator API Server on port 8000")
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    # The development server; use gunicorn for production (see wsgi.py)
+    port = int(os.environ.get('PORT', 8000))
+    debug = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true')
+    logger.info(f"Starting Playlist Generator API Server on port {port}")
+    app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,64 @@
+"""Micro-benchmark for prompt interpretation.
+
+Compares the original per-call substring scans with the compiled parser,
+both uncached and with the LRU cache warm. Run from the server directory:
+
+    python benchmarks/bench_prompt_parser.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_keywords import COMMON_GENRES, FEATURE_KEYWORDS, KEYWORD_TO_GENRE  # noqa: E402
+from prompt_parser import _parse_normalized, normalize, parse_prompt  # noqa: E402
+
+PROMPTS = [
+    "energetic workout mix",
+    "chill lo-fi beats for late night coding",
+    "sad acoustic songs for a rainy autumn evening",
+    "deep house and tech house for a summer party",
+    "instrumental focus music, no vocals",
+    "90s alt rock road trip",
+    "happy upbeat pop to dance to",
+    "dreamy shoegaze and dream pop",
+    "calm jazz for dinner",
+    "trap bangers for the gym",
+]
+
+def legacy_parse(prompt):
+    """The substring scans the parser replaced, rebuilt on every call."""
+    normalized_prompt = prompt.lower()
+    common_genres = list(COMMON_GENRES)
+    found_genres = [genre for genre in common_genres if genre in normalized_prompt]
+    if not found_genres:
+        keyword_to_genre = dict(KEYWORD_TO_GENRE)
+        for keyword, genre in keyword_to_genre.items():
+            if keyword in normalized_prompt:
+                found_genres.append(genre)
+    genres = list(dict.fromkeys(found_genres))
+
+    deltas = {}
+    for feature, (up_words, down_words) in FEATURE_KEYWORDS.items():
+        if any(word in normalized_prompt for word in up_words):
+            deltas[feature] = 1
+        elif any(word in normalized_prompt for word in down_words):
+            deltas[feature] = -1
+    return genres, deltas
+
+def per_prompt_us(func, number):
+    seconds = timeit.timeit(lambda: [func(p) for p in PROMPTS], number=number)
+    return seconds / (number * len(PROMPTS)) * 1e6
+
+def main(number=2000):
+    results = [
+        ("legacy substring scan", per_prompt_us(legacy_parse, number)),
+        ("compiled, uncached", per_prompt_us(lambda p: _parse_normalized.__wrapped__(normalize(p)), number)),
+        ("compiled, cached", per_prompt_us(parse_prompt, number)),
+    ]
+    for name, us in results:
+        print(f"{name:<24} {us:8.2f} us/prompt")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Memory of a loaded library: full Spotify track dicts vs compact Tracks.
+
+Builds realistic track objects with the fake API's generator, round-trips
+them through JSON the way the library cache does, and measures what the
+loaded list costs with tracemalloc. Run from the server directory:
+
+    python benchmarks/bench_track_memory.py --tracks 20000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_spotify import FakeLibrary  # noqa: E402
+from tracks import Track  # noqa: E402
+
+def measure(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    loaded = load()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return loaded, current, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000)
+    args = parser.parse_args()
+
+    library = FakeLibrary(liked=args.tracks)
+    full_rows = [json.dumps(library.track(i)) for i in range(args.tracks)]
+    compact_rows = [json.dumps(Track.from_spotify(json.loads(row)).to_record()) for row in full_rows]
+
+    full, full_bytes, full_seconds = measure(lambda: [json.loads(row) for row in full_rows])
+    del full
+    compact, compact_bytes, compact_seconds = measure(
+        lambda: [Track.from_record(json.loads(row)) for row in compact_rows]
+    )
+    del compact
+
+    print(f"{args.tracks} tracks")
+    print(f"  stored JSON   full {sum(map(len, full_rows)) / 2 ** 20:8.1f} MB   "
+          f"compact {sum(map(len, compact_rows)) / 2 ** 20:8.1f} MB")
+    print(f"  loaded        full {full_bytes / 2 ** 20:8.1f} MB   compact {compact_bytes / 2 ** 20:8.1f} MB   "
+          f"({full_bytes / compact_bytes:.0f}x smaller)")
+    print(f"  load time     full {full_seconds * 1000:8.1f} ms   compact {compact_seconds * 1000:8.1f} ms")
+
+if __name__ == '__main__':
+    main()
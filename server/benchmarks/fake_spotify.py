@@ -0,0 +1,377 @@
+"""A local stand-in for the Spotify Web API serving synthetic libraries.
+
+Tracks, playlists, audio features and artists are derived from their index,
+so a 100k-song library costs no memory until it's requested. Latency and
+rate limiting can be injected to see how the backend behaves under them.
+
+Run it on its own and point the backend at it:
+
+    python benchmarks/fake_spotify.py --liked 20000 --port 9000 --latency-ms 50
+    SPOTIFY_API_PREFIX=http://localhost:9000/v1/ python app.py
+
+GET /__stats reports calls per endpoint and POST /__reset clears them.
+"""
+import argparse
+import hashlib
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, jsonify, request
+
+GENRES = [
+    'rock', 'pop', 'hip hop', 'jazz', 'shoegaze', 'deep house', 'indie pop', 'ambient',
+    'techno', 'folk', 'metal', 'soul', 'dream pop', 'trap', 'classical', 'lo-fi'
+]
+
+# Roughly what Spotify sends per track, so memory measurements are realistic
+MARKETS = [f"{a}{b}" for a in 'ABCDEFGHIJKLMN' for b in 'ABCDEFGHIJKLM'][:180]
+
+def _unit(*parts):
+    """A stable pseudo-random float in [0, 1) for the given key."""
+    digest = hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+def track_id(index):
+    return f"t{index:021d}"
+
+def track_index(track_id_or_uri):
+    return int(track_id_or_uri.rsplit(':', 1)[-1][1:])
+
+def artist_id(index):
+    return f"a{index:021d}"
+
+class FakeLibrary:
+    """Synthetic catalogue and library, plus state for playlists we create."""
+
+    def __init__(self, liked=10000, playlists=50, playlist_size=200, artists=None, seed=0):
+        self.liked = liked
+        self.playlist_count = playlists
+        self.playlist_size = playlist_size
+        self.artists = artists or max(50, liked // 10)
+        self.seed = seed
+        # Created or modified playlists: id -> {'name', 'uris', 'version'}
+        self.playlists = {}
+        self.lock = threading.Lock()
+
+    def track(self, index):
+        artist = int(_unit(self.seed, 'artist', index) * self.artists)
+        year = 1960 + int(_unit(self.seed, 'year', index) * 65)
+        return {
+            'id': track_id(index),
+            'uri': f"spotify:track:{track_id(index)}",
+            'name': f"Track {index}",
+            'type': 'track',
+            'popularity': int(_unit(self.seed, 'popularity', index) * 100),
+            'duration_ms': 120000 + int(_unit(self.seed, 'duration', index) * 240000),
+            'explicit': False,
+            'artists': [{
+                'id': artist_id(artist),
+                'name': f"Artist {artist}",
+                'type': 'artist',
+                'uri': f"spotify:artist:{artist_id(artist)}",
+                'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id(artist)}"}
+            }],
+            'album': {
+                'id': f"b{index // 10:021d}",
+                'name': f"Album {index // 10}",
+                'release_date': f"{year}-01-01",
+                'release_date_precision': 'day',
+                'images': [
+                    {'url': f"https://i.scdn.co/image/{index:040d}", 'height': size, 'width': size}
+                    for size in (640, 300, 64)
+                ],
+                'available_markets': MARKETS,
+                'external_urls': {'spotify': f"https://open.spotify.com/album/b{index // 10:021d}"}
+            },
+            'available_markets': MARKETS,
+            'external_ids': {'isrc': f"XX{index:010d}"},
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id(index)}"},
+            'preview_url': None
+        }
+
+    def audio_features(self, index):
+        def unit(name):
+            return round(_unit(self.seed, name, index), 4)
+        return {
+            'id': track_id(index),
+            'danceability': unit('danceability'),
+            'energy': unit('energy'),
+            'valence': unit('valence'),
+            'tempo': round(60 + 140 * unit('tempo'), 3),
+            'acousticness': unit('acousticness'),
+            'instrumentalness': unit('instrumentalness'),
+            'speechiness': unit('speechiness'),
+            'liveness': unit('liveness'),
+            'loudness': round(-30 + 30 * unit('loudness'), 3)
+        }
+
+    def artist(self, index):
+        count = 1 + int(_unit(self.seed, 'genre-count', index) * 3)
+        genres = [GENRES[int(_unit(self.seed, 'genre', index, n) * len(GENRES))] for n in range(count)]
+        return {'id': artist_id(index), 'name': f"Artist {index}", 'genres': list(dict.fromkeys(genres))}
+
+    def synthetic_playlist_uris(self, number):
+        start = number * 7919
+        return [f"spotify:track:{track_id((start + j) % self.liked)}" for j in range(self.playlist_size)]
+
+    def playlist(self, playlist_id):
+        """(name, uris, snapshot) for a synthetic or created playlist, or None."""
+        with self.lock:
+            if playlist_id in self.playlists:
+                state = self.playlists[playlist_id]
+                return state['name'], list(state['uris']), f"snap-{state['version']}"
+        if playlist_id.startswith('p') and playlist_id[1:].isdigit() and int(playlist_id[1:]) < self.playlist_count:
+            number = int(playlist_id[1:])
+            return f"Playlist {number}", self.synthetic_playlist_uris(number), 'snap-0'
+        return None
+
+    def modify(self, playlist_id, change):
+        """Apply change(uris) to a playlist and return its new snapshot id."""
+        with self.lock:
+            if playlist_id not in self.playlists:
+                existing = None
+                if playlist_id.startswith('p') and playlist_id[1:].isdigit():
+                    number = int(playlist_id[1:])
+                    existing = {'name': f"Playlist {number}", 'uris': self.synthetic_playlist_uris(number), 'version': 0}
+                if existing is None:
+                    return None
+                self.playlists[playlist_id] = existing
+            state = self.playlists[playlist_id]
+            change(state['uris'])
+            state['version'] += 1
+            return f"snap-{state['version']}"
+
+def page(items_for, total, offset, limit, path):
+    offset = max(0, offset)
+    end = min(total, offset + limit)
+    next_url = None
+    if end < total:
+        next_url = f"{request.host_url}v1/{path}?offset={end}&limit={limit}"
+    return {
+        'href': request.url,
+        'items': items_for(offset, end),
+        'limit': limit,
+        'offset': offset,
+        'total': total,
+        'next': next_url,
+        'previous': None
+    }
+
+def create_app(library, latency_ms=0.0, jitter_ms=0.0, throttle=0.0, rps_limit=0, retry_after=1):
+    """Build the fake API.
+
+    `throttle` is the probability of answering 429 to any request, and
+    `rps_limit` a global requests-per-second budget beyond which requests
+    get 429 with `Retry-After: retry_after`.
+    """
+    app = Flask(__name__)
+    calls = Counter()
+    calls_lock = threading.Lock()
+    window = {'second': 0, 'count': 0}
+    window_lock = threading.Lock()
+
+    def count(call):
+        with calls_lock:
+            calls[call] += 1
+
+    def limited(status=429):
+        response = jsonify({'error': {'status': status, 'message': 'API rate limit exceeded'}})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, status
+
+    @app.before_request
+    def simulate_network():
+        if request.path.startswith('/__'):
+            return None
+        count(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}")
+        if latency_ms or jitter_ms:
+            time.sleep((latency_ms + random.random() * jitter_ms) / 1000)
+        if throttle and random.random() < throttle:
+            count('429')
+            return limited()
+        if rps_limit:
+            with window_lock:
+                second = int(time.time())
+                if window['second'] != second:
+                    window['second'], window['count'] = second, 0
+                window['count'] += 1
+                over = window['count'] > rps_limit
+            if over:
+                count('429')
+                return limited()
+        return None
+
+    @app.route('/__stats')
+    def stats():
+        with calls_lock:
+            snapshot = dict(calls)
+        return jsonify({'total': sum(v for k, v in snapshot.items() if k != '429'), 'calls': snapshot})
+
+    @app.route('/__reset', methods=['POST'])
+    def reset():
+        with calls_lock:
+            calls.clear()
+        return jsonify({'status': 'ok'})
+
+    @app.route('/v1/me/')
+    @app.route('/v1/me')
+    def me():
+        return jsonify({'id': 'bench-user', 'display_name': 'Benchmark User', 'type': 'user'})
+
+    @app.route('/v1/me/tracks')
+    def saved_tracks():
+        offset = request.args.get('offset', 0, type=int)
+        limit = min(request.args.get('limit', 20, type=int), 50)
+        now = 1_700_000_000
+
+        def items(start, end):
+            return [
+                {'added_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now - i * 3600)), 'track': library.track(i)}
+                for i in range(start, end)
+            ]
+        return jsonify(page(items, library.liked, offset, limit, 'me/tracks'))
+
+    @app.route('/v1/me/playlists')
+    def my_playlists():
+        offset = request.args.get('offset', 0, type=int)
+        limit = min(request.args.get('limit', 20, type=int), 50)
+
+        def items(start, end):
+            result = []
+            for number in range(start, end):
+                name, uris, snapshot = library.playlist(f"p{number}")
+                result.append({
+                    'id': f"p{number}", 'name': name, 'snapshot_id': snapshot,
+                    'owner': {'id': 'bench-user'}, 'public': False,
+                    'images': [], 'tracks': {'total': len(uris)}
+                })
+            return result
+        return jsonify(page(items, library.playlist_count, offset, limit, 'me/playlists'))
+
+    @app.route('/v1/playlists/<playlist_id>')
+    def get_playlist(playlist_id):
+        found = library.playlist(playlist_id)
+        if not found:
+            return jsonify({'error': {'status': 404, 'message': 'Not found'}}), 404
+        name, uris, snapshot = found
+
+        def items(start, end):
+            return [{'added_at': None, 'track': library.track(track_index(uri))} for uri in uris[start:end]]
+        return jsonify({
+            'id': playlist_id, 'name': name, 'snapshot_id': snapshot,
+            'tracks': page(items, len(uris), 0, 100, f"playlists/{playlist_id}/tracks")
+        })
+
+    @app.route('/v1/playlists/<playlist_id>/tracks', methods=['GET', 'POST', 'PUT', 'DELETE'])
+    def playlist_tracks(playlist_id):
+        found = library.playlist(playlist_id)
+        if not found:
+            return jsonify({'error': {'status': 404, 'message': 'Not found'}}), 404
+        name, uris, snapshot = found
+        body = request.get_json(silent=True)
+
+        if request.method == 'GET':
+            offset = request.args.get('offset', 0, type=int)
+            limit = min(request.args.get('limit', 100, type=int), 100)
+
+            def items(start, end):
+                return [{'added_at': None, 'track': library.track(track_index(uri))} for uri in uris[start:end]]
+            return jsonify(page(items, len(uris), offset, limit, f"playlists/{playlist_id}/tracks"))
+
+        if request.method == 'POST':
+            new_uris = body if isinstance(body, list) else (body or {}).get('uris', [])
+            if len(new_uris) > 100:
+                return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+            position = request.args.get('position', type=int)
+            if position is not None and position > len(uris):
+                return jsonify({'error': {'status': 400, 'message': 'Index out of bounds'}}), 400
+
+            def add(current):
+                at = len(current) if position is None else position
+                current[at:at] = new_uris
+            return jsonify({'snapshot_id': library.modify(playlist_id, add)}), 201
+
+        if body and body.get('snapshot_id') and body['snapshot_id'] != snapshot:
+            # Real Spotify applies changes against the given snapshot; a
+            # stand-in can only refuse stale ones
+            return jsonify({'error': {'status': 409, 'message': 'Snapshot has changed'}}), 409
+
+        if request.method == 'DELETE':
+            remove = {track['uri'] for track in (body or {}).get('tracks', [])}
+            return jsonify({'snapshot_id': library.modify(playlist_id, lambda current: current.__setitem__(
+                slice(None), [uri for uri in current if uri not in remove]
+            ))})
+
+        # PUT: replace when given uris, otherwise reorder a range
+        if 'uris' in (body or {}):
+            return jsonify({'snapshot_id': library.modify(playlist_id, lambda current: current.__setitem__(
+                slice(None), list(body['uris'])
+            ))}), 201
+
+        start, before, length = body['range_start'], body['insert_before'], body.get('range_length', 1)
+
+        def reorder(current):
+            moved = current[start:start + length]
+            target = before if before <= start else before - length
+            del current[start:start + length]
+            current[target:target] = moved
+        return jsonify({'snapshot_id': library.modify(playlist_id, reorder)})
+
+    @app.route('/v1/users/<user_id>/playlists', methods=['POST'])
+    def create_playlist(user_id):
+        body = request.get_json(silent=True) or {}
+        with library.lock:
+            playlist_id = f"c{len(library.playlists):021d}"
+            library.playlists[playlist_id] = {'name': body.get('name', ''), 'uris': [], 'version': 0}
+        return jsonify({'id': playlist_id, 'name': body.get('name', ''), 'snapshot_id': 'snap-0'}), 201
+
+    @app.route('/v1/audio-features/')
+    @app.route('/v1/audio-features')
+    def audio_features():
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+        if len(ids) > 100:
+            return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+        return jsonify({'audio_features': [library.audio_features(track_index(i)) for i in ids]})
+
+    @app.route('/v1/artists/')
+    @app.route('/v1/artists')
+    def artists():
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+        if len(ids) > 50:
+            return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+        return jsonify({'artists': [library.artist(int(i[1:])) for i in ids]})
+
+    @app.route('/v1/recommendations')
+    def recommendations():
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        key = request.query_string.decode()
+        catalogue = library.liked * 2
+        start = int(_unit(library.seed, 'recommendations', key) * catalogue)
+        return jsonify({'tracks': [library.track((start + j) % catalogue) for j in range(limit)], 'seeds': []})
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--liked', type=int, default=10000, help='number of liked songs')
+    parser.add_argument('--playlists', type=int, default=50)
+    parser.add_argument('--playlist-size', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='random extra latency, up to this much')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability of a 429 per request')
+    parser.add_argument('--rps-limit', type=int, default=0, help='requests per second before 429s (0 = none)')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    library = FakeLibrary(liked=args.liked, playlists=args.playlists, playlist_size=args.playlist_size)
+    app = create_app(
+        library, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        throttle=args.throttle, rps_limit=args.rps_limit, retry_after=args.retry_after
+    )
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
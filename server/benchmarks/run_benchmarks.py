@@ -0,0 +1,168 @@
+"""End-to-end benchmarks against a local fake Spotify API.
+
+Starts benchmarks/fake_spotify.py with a synthetic library, points the
+backend at it with an empty cache, and drives the main endpoints with
+concurrent clients. Each scenario reports latency percentiles, throughput,
+the outbound Spotify calls it caused and, with --memory, peak Python
+allocations. Run from the server directory:
+
+    python benchmarks/run_benchmarks.py --liked 20000 --latency-ms 30
+    python benchmarks/run_benchmarks.py --json > results.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADERS = {'Authorization': 'Bearer benchmark-token'}
+PROMPTS = [
+    "energetic workout mix",
+    "chill lo-fi beats for late night coding",
+    "sad acoustic songs for a rainy autumn evening",
+    "deep house for a summer party",
+    "instrumental focus music, no vocals",
+    "happy upbeat pop to dance to",
+    "dreamy shoegaze and dream pop",
+    "calm jazz for dinner",
+]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_fake_spotify(args):
+    port = free_port()
+    command = [
+        sys.executable, os.path.join(SERVER_DIR, 'benchmarks', 'fake_spotify.py'),
+        '--port', str(port), '--liked', str(args.liked), '--playlists', str(args.playlists),
+        '--playlist-size', str(args.playlist_size), '--latency-ms', str(args.latency_ms),
+        '--throttle', str(args.throttle)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{base}/__stats", timeout=1)
+            return process, base
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fake Spotify API did not start")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_scenario(client, fake_base, name, method, path, body_for, requests_count, concurrency, memory):
+    """Send `requests_count` requests with `concurrency` clients and summarise them."""
+    requests.post(f"{fake_base}/__reset")
+
+    def send(i):
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body_for(i) if body_for else None, headers=HEADERS)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(send, range(requests_count)))
+    else:
+        results = [send(i) for i in range(requests_count)]
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies = [latency for latency, _ in results]
+    outbound = requests.get(f"{fake_base}/__stats").json()
+    return {
+        "scenario": name,
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, status in results if status >= 400),
+        "p50Ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p95Ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "maxMs": round(max(latencies) * 1000, 1),
+        "throughput": round(requests_count / elapsed, 2),
+        "spotifyCalls": outbound["total"],
+        "spotifyThrottled": outbound["calls"].get("429", 0),
+        "peakMemoryMb": round(peak / 2 ** 20, 1) if peak is not None else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--liked', type=int, default=10000, help='liked songs in the synthetic library')
+    parser.add_argument('--playlists', type=int, default=200)
+    parser.add_argument('--playlist-size', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='added to every fake API call')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability of a 429 per fake API call')
+    parser.add_argument('--requests', type=int, default=20, help='requests per warm scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--memory', action='store_true', help='trace peak allocations (slows everything down)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    process, fake_base = start_fake_spotify(args)
+    cache_dir = tempfile.mkdtemp(prefix='playlist-bench-')
+    # The backend reads these at import time
+    os.environ['SPOTIFY_API_PREFIX'] = f"{fake_base}/v1/"
+    os.environ['LIBRARY_CACHE_DIR'] = cache_dir
+    sys.path.insert(0, SERVER_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    from app import app  # noqa: E402
+
+    client = app.test_client()
+    n, c = args.requests, args.concurrency
+
+    def generate(mode):
+        return lambda i: {"sourcePlaylistId": "liked_songs", "prompt": PROMPTS[i % len(PROMPTS)], "selectionMode": mode}
+
+    scenarios = [
+        ("generate cold (liked songs sync)", 'POST', '/api/playlists/generate', generate('local'), 1, 1),
+        ("generate warm, local", 'POST', '/api/playlists/generate', generate('local'), n, c),
+        ("generate warm, recommendations", 'POST', '/api/playlists/generate', generate('recommendations'), n, c),
+        ("list playlists", 'GET', '/api/me/playlists', None, n, c),
+        ("generate batch, 8 prompts", 'POST', '/api/playlists/generate-batch',
+         lambda i: {"sourcePlaylistId": "liked_songs", "prompts": PROMPTS, "selectionMode": "local"}, max(1, n // 4), 1),
+        ("cluster library", 'POST', '/api/library/cluster',
+         lambda i: {"sourcePlaylistId": "liked_songs", "clusterSize": 200}, max(1, n // 4), 1),
+    ]
+
+    results = []
+    try:
+        for name, method, path, body_for, count, concurrency in scenarios:
+            results.append(run_scenario(client, fake_base, name, method, path, body_for, count, concurrency, args.memory))
+    finally:
+        process.terminate()
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "results": results}, indent=2))
+        return
+
+    print(f"Library: {args.liked} liked songs, {args.playlists} playlists, "
+          f"{args.latency_ms:g} ms API latency, {args.throttle:g} throttle\n")
+    print(f"{'scenario':34} {'reqs':>5} {'conc':>4} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'max ms':>9} {'req/s':>8} {'api calls':>9} {'429s':>5} {'peak MB':>8}")
+    for r in results:
+        peak = '-' if r['peakMemoryMb'] is None else f"{r['peakMemoryMb']:.1f}"
+        print(f"{r['scenario']:34} {r['requests']:5} {r['concurrency']:4} {r['errors']:4} {r['p50Ms']:9.1f} "
+              f"{r['p95Ms']:9.1f} {r['maxMs']:9.1f} {r['throughput']:8.2f} {r['spotifyCalls']:9} "
+              f"{r['spotifyThrottled']:5} {peak:>8}")
+
+if __name__ == '__main__':
+    main()
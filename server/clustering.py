@@ -0,0 +1,149 @@
+import logging
+
+import numpy as np
+
+from feature_store import COLUMN_INDEX
+from prompt_keywords import FEATURE_KEYWORDS, KEYWORD_TO_GENRE
+
+logger = logging.getLogger(__name__)
+
+# Features the library is clustered on
+CLUSTER_FEATURES = (
+    'danceability', 'energy', 'valence', 'tempo', 'acousticness',
+    'instrumentalness', 'speechiness'
+)
+
+# How many standard deviations a centroid has to sit from the library mean
+# before the feature is worth mentioning in its label
+LABEL_THRESHOLD = 0.4
+
+def standardize(features):
+    """Scale each column to zero mean and unit variance so tempo doesn't dominate."""
+    mean = features.mean(axis=0)
+    std = features.std(axis=0)
+    std[std == 0] = 1.0
+    return (features - mean) / std
+
+def squared_distances(points, centers):
+    """Squared euclidean distance from every point to every center."""
+    distances = (
+        (points ** 2).sum(axis=1)[:, None]
+        - 2 * points @ centers.T
+        + (centers ** 2).sum(axis=1)[None, :]
+    )
+    return np.maximum(distances, 0)
+
+def kmeans_plus_plus(points, k, rng):
+    """Pick k initial centers spread out over the data (k-means++)."""
+    centers = [points[rng.integers(len(points))]]
+    closest = squared_distances(points, centers[0][None, :])[:, 0]
+    for _ in range(1, k):
+        total = closest.sum()
+        if total == 0:
+            index = rng.integers(len(points))
+        else:
+            index = rng.choice(len(points), p=closest / total)
+        centers.append(points[index])
+        closest = np.minimum(closest, squared_distances(points, points[index][None, :])[:, 0])
+    return np.array(centers)
+
+def mini_batch_kmeans(points, k, batch_size=1024, max_iter=200, tol=1e-4, seed=0):
+    """Cluster the rows of `points` into k groups with mini-batch k-means.
+
+    Each iteration moves the centers towards the mean of a random batch with a
+    per-center learning rate that shrinks as the center absorbs more points,
+    so the cost per iteration doesn't depend on the library size. Returns
+    (centers, labels) where labels assigns every row to its nearest center.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(points)
+    k = min(k, n)
+
+    # Seeding on a sample keeps k-means++ cheap on large libraries
+    sample = points[rng.choice(n, min(n, 10 * batch_size), replace=False)]
+    centers = kmeans_plus_plus(sample, k, rng)
+    counts = np.zeros(k)
+
+    for iteration in range(max_iter):
+        batch = points[rng.choice(n, min(n, batch_size), replace=False)]
+        labels = squared_distances(batch, centers).argmin(axis=1)
+
+        batch_counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, batch)
+
+        hit = batch_counts > 0
+        counts[hit] += batch_counts[hit]
+        rate = batch_counts[hit] / counts[hit]
+        previous = centers.copy()
+        centers[hit] += rate[:, None] * (sums[hit] / batch_counts[hit, None] - centers[hit])
+
+        if np.abs(centers - previous).max() < tol:
+            logger.info(f"Mini-batch k-means converged after {iteration + 1} iterations")
+            break
+
+    labels = squared_distances(points, centers).argmin(axis=1)
+    return centers, labels
+
+def describe_centroid(centroid, feature_names):
+    """Turn a standardized centroid into prompt keywords and genres.
+
+    Features that stand out from the library mean are mapped to the first
+    up/down word for that feature in FEATURE_KEYWORDS, strongest first, and
+    those words are looked up in KEYWORD_TO_GENRE for genre hints.
+    """
+    keywords = []
+    for i in np.argsort(-np.abs(centroid)):
+        if abs(centroid[i]) < LABEL_THRESHOLD:
+            break
+        name = feature_names[i]
+        if name not in FEATURE_KEYWORDS:
+            continue
+        up_words, down_words = FEATURE_KEYWORDS[name]
+        words = up_words if centroid[i] > 0 else down_words
+        if words and words[0] not in keywords:
+            keywords.append(words[0])
+
+    genres = []
+    for word in keywords:
+        genre = KEYWORD_TO_GENRE.get(word)
+        if genre and genre not in genres:
+            genres.append(genre)
+
+    return keywords[:3], genres
+
+def cluster_library(features, k, seed=0):
+    """Cluster feature store rows and describe each cluster.
+
+    `features` is the (n_tracks, n_features) matrix from the feature store.
+    Rows without features are left out and returned as `unclustered` row
+    indices. Each cluster has its member rows, keywords, genres and the
+    centroid in original units.
+    """
+    columns = [COLUMN_INDEX[name] for name in CLUSTER_FEATURES]
+    subset = np.asarray(features[:, columns], dtype=np.float64)
+    usable = ~np.isnan(subset).any(axis=1)
+    rows = np.flatnonzero(usable)
+    if len(rows) == 0:
+        return [], np.flatnonzero(~usable)
+
+    usable_features = subset[rows]
+    points = standardize(usable_features)
+    centers, labels = mini_batch_kmeans(points, k, seed=seed)
+
+    clusters = []
+    for cluster in range(len(centers)):
+        members = rows[labels == cluster]
+        if len(members) == 0:
+            continue
+        keywords, genres = describe_centroid(centers[cluster], CLUSTER_FEATURES)
+        centroid = usable_features[labels == cluster].mean(axis=0)
+        clusters.append({
+            "rows": members,
+            "keywords": keywords,
+            "genres": genres,
+            "centroid": {name: round(float(value), 3) for name, value in zip(CLUSTER_FEATURES, centroid)}
+        })
+
+    clusters.sort(key=lambda c: len(c["rows"]), reverse=True)
+    return clusters, np.flatnonzero(~usable)
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+from contextlib import closing, contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+from library_cache import CACHE_DIR
+from paging import iter_batches
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+FEATURE_STORE_DIR = os.environ.get('FEATURE_STORE_DIR', os.path.join(CACHE_DIR, 'features'))
+
+# Column order of the feature matrix
+FEATURE_COLUMNS = (
+    'danceability', 'energy', 'valence', 'tempo', 'acousticness',
+    'instrumentalness', 'speechiness', 'liveness', 'loudness'
+)
+COLUMN_INDEX = {name: i for i, name in enumerate(FEATURE_COLUMNS)}
+
+# Windows can't replace a file while it's mapped, so there the matrix is
+# read into memory instead
+MMAP_MODE = 'r' if os.name != 'nt' else None
+
+AUDIO_FEATURES_BATCH_SIZE = 100  # Spotify's limit for one audio_features call
+
+# Requests for the same source run into the same missing batches at once
+_audio_features_flights = SingleFlight('audio_features')
+
+class FeatureStore:
+    """Audio features for every track we've seen, as one float32 matrix.
+
+    Row i of `features.npy` holds the features of the track id at position i
+    of `track_ids.npy`. Both files are opened memory-mapped, so restarts and
+    other worker processes share the page cache instead of refetching or
+    copying. Tracks Spotify has no features for are stored as NaN rows so
+    they aren't requested again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.features_path = os.path.join(directory, 'features.npy')
+        self.ids_path = os.path.join(directory, 'track_ids.npy')
+        self.lock_path = os.path.join(directory, '.lock')
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.features = np.empty((0, len(FEATURE_COLUMNS)), dtype=np.float32)
+        self.track_ids = np.empty(0, dtype='U22')
+        self.index = {}
+        # Track ids asked for by ensure() that were already stored, or not
+        self.hits = 0
+        self.misses = 0
+
+    def _refresh(self):
+        """Reload the memory-mapped files if another process rewrote them."""
+        try:
+            mtime = os.stat(self.features_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        self.features = np.load(self.features_path, mmap_mode=MMAP_MODE)
+        self.track_ids = np.load(self.ids_path, mmap_mode=MMAP_MODE)
+        # The matrix only ever grows, so if we caught a writer between its two
+        # renames the shorter file is still a consistent prefix
+        count = min(len(self.features), len(self.track_ids))
+        self.index = {track_id: row for row, track_id in enumerate(self.track_ids[:count].tolist())}
+        self._mtime = mtime
+        logger.info(f"Loaded feature store with {len(self.index)} tracks")
+
+    def rows(self, track_ids):
+        """Return a (len(track_ids), n_features) matrix, NaN where unknown."""
+        with self._lock:
+            self._refresh()
+            features, index = self.features, self.index
+        rows = np.array([index.get(track_id, -1) for track_id in track_ids], dtype=np.intp)
+        result = np.full((len(track_ids), len(FEATURE_COLUMNS)), np.nan, dtype=np.float32)
+        known = rows >= 0
+        result[known] = features[rows[known]]
+        return result
+
+    def missing(self, track_ids):
+        """Track ids from `track_ids` that aren't in the store yet."""
+        with self._lock:
+            self._refresh()
+            index = self.index
+        return list(dict.fromkeys(track_id for track_id in track_ids if track_id not in index))
+
+    def ensure(self, sp, track_ids, progress=None):
+        """Fetch and store features for any of `track_ids` not cached yet."""
+        missing = self.missing(track_ids)
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(set(track_ids)) - len(missing)
+        if not missing:
+            return 0
+
+        def fetch_batch(batch):
+            # A batch already being fetched for another request is shared
+            return _audio_features_flights.do(tuple(batch), lambda: sp.audio_features(batch))
+
+        matrices = []
+        with closing(iter_batches(fetch_batch, missing, AUDIO_FEATURES_BATCH_SIZE)) as results:
+            for features in results:
+                matrices.append(features_to_matrix(features))
+                if progress:
+                    progress('features', fetched=sum(len(m) for m in matrices), total=len(missing))
+        new_rows = np.vstack(matrices)
+
+        self.append(missing, new_rows)
+        logger.info(f"Fetched audio features for {len(missing)} tracks in {len(matrices)} calls")
+        return len(missing)
+
+    def append(self, track_ids, rows):
+        """Add rows to the on-disk matrix and swap the new files in atomically."""
+        os.makedirs(self.directory, exist_ok=True)
+        # Serialise writers across worker processes
+        with exclusive_file_lock(self.lock_path):
+            with self._lock:
+                self._refresh()
+                fresh = [i for i, track_id in enumerate(track_ids) if track_id not in self.index]
+                if not fresh:
+                    return
+                features = np.concatenate([np.asarray(self.features), rows[fresh]]).astype(np.float32)
+                ids = np.concatenate([np.asarray(self.track_ids), np.array([track_ids[i] for i in fresh])])
+                save_atomically(self.ids_path, ids)
+                # Features are written last since their mtime signals the reload
+                save_atomically(self.features_path, features)
+                self._mtime = None
+                self._refresh()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 4) if lookups else None
+        }
+
+@contextmanager
+def exclusive_file_lock(path):
+    """Hold an exclusive lock on `path` that other processes wait for."""
+    with open(path, 'a+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+        lock_file.seek(0)
+        while True:
+            try:
+                # Blocks for up to 10s at a time, then raises
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def save_atomically(path, array):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def features_to_matrix(audio_features):
+    """Convert a list of Spotify audio feature dicts (or None) to matrix rows."""
+    matrix = np.full((len(audio_features), len(FEATURE_COLUMNS)), np.nan, dtype=np.float32)
+    for row, features in enumerate(audio_features):
+        if features:
+            matrix[row] = [np.nan if features.get(name) is None else features[name] for name in FEATURE_COLUMNS]
+    return matrix
+
+feature_store = FeatureStore(FEATURE_STORE_DIR)
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import closing
+
+from library_cache import connect
+from paging import iter_batches
+from prompt_parser import normalize
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ARTISTS_BATCH_SIZE = 50  # Spotify's limit for one artists call
+# Artist genres change rarely; refetch them after this long
+ARTIST_GENRE_TTL_SECONDS = int(os.environ.get('ARTIST_GENRE_TTL_SECONDS', 7 * 24 * 3600))
+# Genre indexes kept in memory, one per (user, source)
+GENRE_INDEX_CACHE_SIZE = int(os.environ.get('GENRE_INDEX_CACHE_SIZE', 64))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artist_genres (
+    artist_id TEXT PRIMARY KEY,
+    genres TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+_schema_ready = False
+
+def _connect():
+    global _schema_ready
+    conn = connect()
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+def artist_genres(sp, artist_ids, progress=None):
+    """Return {artist id: tuple of genres}, fetching unknown or stale artists.
+
+    Genres are kept in the library store, so they're shared by every user
+    and source and survive restarts. Missing artists are looked up 50 per
+    call, several calls at a time.
+    """
+    artist_ids = list(dict.fromkeys(artist_ids))
+    genres = {}
+    with closing(_connect()) as conn:
+        fresh_after = time.time() - ARTIST_GENRE_TTL_SECONDS
+        for i in range(0, len(artist_ids), 500):
+            chunk = artist_ids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT artist_id, genres FROM artist_genres WHERE fetched_at > ? "
+                f"AND artist_id IN ({','.join('?' * len(chunk))})",
+                [fresh_after, *chunk]
+            )
+            genres.update((artist_id, tuple(json.loads(g))) for artist_id, g in rows)
+
+        missing = [artist_id for artist_id in artist_ids if artist_id not in genres]
+        if not missing:
+            return genres
+
+        fetched = {}
+        calls = 0
+        with closing(iter_batches(sp.artists, missing, ARTISTS_BATCH_SIZE)) as results:
+            for result in results:
+                calls += 1
+                for artist in result['artists']:
+                    if artist:
+                        fetched[artist['id']] = tuple(artist.get('genres') or ())
+                if progress:
+                    progress('genres', fetched=len(fetched), total=len(missing))
+
+        now = time.time()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO artist_genres (artist_id, genres, fetched_at) VALUES (?, ?, ?)',
+                [(artist_id, json.dumps(g), now) for artist_id, g in fetched.items()]
+            )
+    logger.info(f"Fetched genres for {len(fetched)} artists in {calls} calls")
+    genres.update(fetched)
+    return genres
+
+class GenreIndex:
+    """Track ids by artist genre for one source.
+
+    Built once per source and then kept up to date by adding and removing
+    only the tracks that changed, so looking up a genre never scans the
+    library.
+    """
+
+    def __init__(self):
+        self.tracks = {}
+        self.by_genre = defaultdict(set)
+        self._track_genres = {}
+        self._keys = {}
+        self.lock = threading.Lock()
+
+    def update(self, sp, tracks, progress=None):
+        """Bring the index in line with `tracks`. Returns (added, removed) counts."""
+        with self.lock:
+            return self._update(sp, tracks, progress)
+
+    def _update(self, sp, tracks, progress):
+        current = {track.id: track for track in tracks}
+        added = [track for track_id, track in current.items() if track_id not in self.tracks]
+        removed = [track_id for track_id in self.tracks if track_id not in current]
+
+        if added:
+            genres = artist_genres(sp, [a for track in added for a in track.artist_ids], progress)
+            for track in added:
+                track_genres = {g for artist_id in track.artist_ids for g in genres.get(artist_id, ())}
+                self.tracks[track.id] = track
+                self._track_genres[track.id] = track_genres
+                for genre in track_genres:
+                    self.by_genre[genre].add(track.id)
+        for track_id in removed:
+            del self.tracks[track_id]
+            for genre in self._track_genres.pop(track_id):
+                self.by_genre[genre].discard(track_id)
+                if not self.by_genre[genre]:
+                    del self.by_genre[genre]
+        if added or removed:
+            self._keys.clear()
+        return len(added), len(removed)
+
+    def genre_keys(self, genre):
+        """Artist genres that contain `genre` as whole words, e.g. "house" -> "deep house"."""
+        keys = self._keys.get(genre)
+        if keys is None:
+            wanted = f" {normalize(genre)} "
+            keys = self._keys[genre] = [key for key in self.by_genre if wanted in f" {normalize(key)} "]
+        return keys
+
+    def lookup(self, genres):
+        """Tracks matching any of `genres`, ordered by id for a stable result."""
+        with self.lock:
+            ids = set()
+            for genre in genres:
+                for key in self.genre_keys(genre):
+                    ids |= self.by_genre[key]
+            return [self.tracks[track_id] for track_id in sorted(ids)]
+
+_indexes = TTLCache(GENRE_INDEX_CACHE_SIZE)
+
+def genre_index(sp, user_id, source_id, tracks, progress=None):
+    """The genre index for a source, updated to its current tracks."""
+    key = (user_id, source_id)
+    index = _indexes.get(key)
+    if index is None:
+        index = GenreIndex()
+        _indexes.set(key, index)
+    added, removed = index.update(sp, tracks, progress)
+    if added or removed:
+        logger.info(f"Genre index for {source_id}: {added} added, {removed} removed, {len(index.by_genre)} genres")
+    return index
@@ -0,0 +1,31 @@
+"""Gunicorn settings for serving the backend, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Sizes, timeouts and the access log can be set with environment variables;
+the worker class and preloading are fixed.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+# Requests mostly wait on Spotify, so each worker serves several at once on
+# threads. Workers share the library store, feature matrices and caches.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Load the app once before forking, so workers start fast and share its memory
+preload_app = True
+# Job event streams stay open for a while; this is only the worker heartbeat
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+# '-' logs requests to stdout; set WEB_ACCESS_LOG to a path, or empty to turn it off
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-') or None
+
+def post_fork(server, worker):
+    """Split the app-wide Spotify rate limit between the workers and publish their metrics."""
+    from rate_limit import scheduler
+    from shared_metrics import start_publishing
+
+    scheduler.share(server.cfg.workers)
+    start_publishing()
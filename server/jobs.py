@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Jobs waiting for a worker beyond this are rejected instead of queued
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 100))
+# Finished jobs are kept this long so clients can still read the result
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))
+# How often a worker serving another worker's job rereads it, e.g. for events
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 0.5))
+
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled')
+
+class JobCancelled(Exception):
+    """Raised inside a job at its next progress update after cancellation."""
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting for a worker."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    progress TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    version INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER NOT NULL
+);
+"""
+
+class JobStore:
+    """Job state in the library store, so every worker process can serve any job.
+
+    The worker running a job writes its state on every change. Other
+    workers read it from here and cancel it by setting its flag, which the
+    running worker checks at each progress update.
+    """
+
+    _schema_ready = False
+
+    def _connect(self):
+        # Imported here because library_cache imports JobCancelled from this module
+        from library_cache import connect
+        conn = connect()
+        if not JobStore._schema_ready:
+            conn.executescript(SCHEMA)
+            JobStore._schema_ready = True
+        return conn
+
+    def save(self, job):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, owner, status, stage, progress, result, error, created_at, '
+                'finished_at, version, cancelled, pid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET status = excluded.status, stage = excluded.stage, '
+                'progress = excluded.progress, result = excluded.result, error = excluded.error, '
+                'finished_at = excluded.finished_at, version = excluded.version, '
+                'cancelled = MAX(cancelled, excluded.cancelled)',
+                (
+                    job.id, job.kind, job.owner, job.status, job.stage, json.dumps(dict(job.progress)),
+                    json.dumps(job.result), job.error, job.created_at, job.finished_at, job.version,
+                    int(job._cancelled.is_set()), os.getpid()
+                )
+            )
+
+    def load(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT id, kind, owner, status, stage, progress, result, error, created_at, finished_at, '
+                'version, pid FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        return StoredJob(self, *row) if row else None
+
+    def cancel(self, job_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('UPDATE jobs SET cancelled = 1 WHERE id = ?', (job_id,))
+
+    def cancelled(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT cancelled FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def abandon(self, job_id, version):
+        """Fail a job whose worker process is gone, unless it changed since `version`."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, version = version + 1 "
+                "WHERE id = ? AND version = ?",
+                ('The worker running this job exited', time.time(), job_id, version)
+            )
+
+    def prune(self, cutoff):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (cutoff,))
+
+class Job:
+    """State of one background job, shared between its worker and readers.
+
+    Workers report through `update`, which doubles as the cancellation
+    checkpoint. Readers can block in `wait_for_change` to stream updates.
+    Every change is also saved to the store for other worker processes.
+    """
+
+    def __init__(self, kind, owner, store=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.owner = owner
+        self.status = 'queued'
+        self.stage = None
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self._cancelled = threading.Event()
+        self._changed = threading.Condition()
+        self._store = store
+
+    def _bump(self):
+        with self._changed:
+            self.version += 1
+            if self._store:
+                self._store.save(self)
+            self._changed.notify_all()
+
+    def update(self, stage, **counts):
+        """Record progress for a stage, e.g. update('fetching', fetched=50, total=900).
+
+        Repeating the current progress only checks for cancellation.
+        """
+        if self.cancelled:
+            raise JobCancelled()
+        if stage == self.stage and self.progress.get(stage) == counts:
+            return
+        self.stage = stage
+        self.progress[stage] = counts
+        self._bump()
+
+    def start(self):
+        self.status = 'running'
+        self._bump()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._bump()
+
+    @property
+    def cancelled(self):
+        if not self._cancelled.is_set() and self._store and self._store.cancelled(self.id):
+            # Cancelled through another worker process
+            self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._bump()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes past `version` or the timeout passes."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "finishedAt": self.finished_at
+        }
+
+class StoredJob:
+    """A job run by another worker process, read from the store.
+
+    Offers the same reads as Job, plus cancelling; waiting for a change
+    polls the store.
+    """
+
+    def __init__(self, store, id, kind, owner, status, stage, progress, result, error, created_at,
+                 finished_at, version, pid):
+        self._store = store
+        self.id = id
+        self.kind = kind
+        self.owner = owner
+        self.status = status
+        self.stage = stage
+        self.progress = json.loads(progress)
+        self.result = json.loads(result) if result is not None else None
+        self.error = error
+        self.created_at = created_at
+        self.finished_at = finished_at
+        self.version = version
+        self.pid = pid
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def cancel(self):
+        self._store.cancel(self.id)
+
+    def refresh(self):
+        """Reread the job, failing it if the process running it has exited."""
+        stored = self._store.load(self.id)
+        if stored is None:
+            return
+        if not stored.finished and not process_alive(stored.pid):
+            self._store.abandon(stored.id, stored.version)
+            stored = self._store.load(self.id) or stored
+        self.__dict__.update(stored.__dict__)
+
+    def wait_for_change(self, version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            if self.version != version or time.monotonic() >= deadline:
+                return self.version
+            time.sleep(min(JOB_POLL_SECONDS, max(0, deadline - time.monotonic())))
+
+    to_dict = Job.to_dict
+
+def process_alive(pid):
+    """Whether a worker process on this machine is still running."""
+    if pid == os.getpid():
+        # Its jobs would be in memory; this one is from an earlier process
+        return False
+    if os.name != 'posix':
+        # os.kill would end the process on Windows; assume it's alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobManager:
+    """Runs jobs on a bounded worker pool and keeps them around for polling."""
+
+    def __init__(self, max_workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS, store=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._max_pending = max_pending
+        self._store = store
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, owner, func):
+        """Queue `func(job)` and return the job right away.
+
+        Whatever `func` returns becomes the job's result. Exceptions fail the
+        job, and JobCancelled marks it cancelled.
+        """
+        with self._lock:
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if job.status == 'queued')
+            if pending >= self._max_pending:
+                raise JobQueueFull(f"{pending} jobs already waiting")
+            job = Job(kind, owner, self._store)
+            self._jobs[job.id] = job
+        if self._store:
+            self._store.save(job)
+
+        self._executor.submit(self._run, job, func)
+        logger.info(f"Queued {kind} job {job.id}")
+        return job
+
+    def _run(self, job, func):
+        # Imported here because playlist_writer imports library_cache, which imports this module
+        from playlist_writer import PlaylistWriteError
+        if job.cancelled:
+            job.finish('cancelled')
+            return
+        job.start()
+        try:
+            result = func(job)
+        except JobCancelled:
+            logger.info(f"Job {job.id} cancelled during {job.stage}")
+            job.finish('cancelled')
+        except PlaylistWriteError as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            # Kept so the client can pass them to the resume endpoint
+            job.finish('failed', result={"writeId": e.write_id, "playlistId": e.playlist_id}, error=str(e))
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.finish('failed', error=str(e))
+        else:
+            job.finish('succeeded', result=result)
+
+    def get(self, job_id):
+        """A job of this process, or one another worker process is running or ran."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._store:
+            job = self._store.load(job_id)
+            if job:
+                job.refresh()
+        return job
+
+    def counts(self):
+        """Number of jobs currently held, by status."""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return [((status,), statuses.count(status)) for status in ('queued', 'running') + FINISHED_STATUSES]
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+        if self._store:
+            self._store.prune(cutoff)
+
+job_manager = JobManager(store=JobStore())
@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from jobs import JobCancelled
+from paging import fetch_all_pages, iter_pages
+from singleflight import SingleFlight
+from tracks import Track
+
+logger = logging.getLogger(__name__)
+
+# On-disk track store shared by every request. Override the location with
+# LIBRARY_CACHE_PATH, e.g. to put it on a faster disk.
+CACHE_DIR = os.environ.get(
+    'LIBRARY_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+)
+LIBRARY_CACHE_PATH = os.environ.get('LIBRARY_CACHE_PATH', os.path.join(CACHE_DIR, 'library.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS liked_tracks (
+    user_id TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    added_at TEXT NOT NULL,
+    track TEXT NOT NULL,
+    PRIMARY KEY (user_id, track_id)
+);
+CREATE INDEX IF NOT EXISTS liked_tracks_added_at ON liked_tracks (user_id, added_at);
+CREATE TABLE IF NOT EXISTS liked_sync (
+    user_id TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    skipped INTEGER,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track TEXT NOT NULL,
+    PRIMARY KEY (user_id, playlist_id, position)
+);
+CREATE TABLE IF NOT EXISTS playlist_sync (
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    name TEXT,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (user_id, playlist_id)
+);
+"""
+
+_schema_ready = False
+
+# Concurrent syncs of the same source share one fetch
+_liked_songs_flights = SingleFlight('liked_songs')
+_playlist_flights = SingleFlight('playlist')
+_playlist_tracks_flights = SingleFlight('playlist_tracks')
+
+def connect():
+    """Open a connection to the library store, creating the schema on first use."""
+    global _schema_ready
+    os.makedirs(os.path.dirname(LIBRARY_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(LIBRARY_CACHE_PATH, timeout=30)
+    if not _schema_ready:
+        # WAL lets readers keep going while a sync is writing
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(liked_sync)')}
+        if 'skipped' not in columns:
+            # Stores from before skipped items were counted. Their rows are
+            # left NULL, so those users get one full sync.
+            conn.execute('ALTER TABLE liked_sync ADD COLUMN skipped INTEGER')
+        _schema_ready = True
+    return conn
+
+def is_usable_track(track):
+    """Local files and removed tracks come back as None or without an id."""
+    return bool(track and track.get('id'))
+
+def sync_liked_songs(sp, user_id, progress=None):
+    """Bring the cached liked songs for a user up to date and return them.
+
+    Callers arriving while a sync for the same user is running get its
+    result and its progress. Liked songs have no snapshot id, so the user
+    alone is the key.
+    """
+    def sync(report):
+        update_liked_songs(sp, user_id, report)
+        with closing(connect()) as conn:
+            return load_liked_songs(conn, user_id)
+    return _liked_songs_flights.do_reporting(('sync', user_id), sync, progress, retry_on=JobCancelled)
+
+def update_liked_songs(sp, user_id, progress=None):
+    """Bring the cached liked songs for a user up to date, or wait for a running update."""
+    _liked_songs_flights.do_reporting(
+        ('update', user_id), lambda report: _update_liked_songs(sp, user_id, report), progress,
+        retry_on=JobCancelled
+    )
+
+def _update_liked_songs(sp, user_id, progress=None):
+    """Bring the cached liked songs for a user up to date.
+
+    Spotify returns saved tracks newest first, so paging stops as soon as it
+    reaches an (track, added_at) pair that is already stored. If more tracks
+    are stored than Spotify's total less the unusable items it counts, tracks
+    were removed and the user's liked songs are refetched from scratch.
+    `progress(stage, **counts)` is told how many tracks have been fetched so
+    far.
+    """
+    with closing(connect()) as conn:
+        results = sp.current_user_saved_tracks(limit=50)
+        synced = conn.execute('SELECT skipped FROM liked_sync WHERE user_id = ?', (user_id,)).fetchone()
+        if not synced or synced[0] is None:
+            # Nothing cached yet, a full sync was interrupted, or the last one
+            # didn't count skipped items. Every page is needed, so they can be
+            # fetched in parallel.
+            _full_liked_songs_sync(sp, user_id, first_page=results, progress=progress)
+            return
+
+        known = dict(conn.execute(
+            'SELECT track_id, added_at FROM liked_tracks WHERE user_id = ?', (user_id,)
+        ).fetchall())
+
+        new_rows = []
+        total = results['total']
+        skipped = synced[0]
+        reached_known = False
+        fetched = 0
+        while True:
+            fetched += len(results['items'])
+            if progress:
+                progress('fetching', fetched=fetched, total=total)
+            for item in results['items']:
+                track = item['track']
+                if not is_usable_track(track):
+                    skipped += 1
+                    continue
+                if known.get(track['id']) == item['added_at']:
+                    reached_known = True
+                    break
+                new_rows.append((user_id, track['id'], item['added_at'], track_json(track)))
+            if reached_known or not results['next']:
+                break
+            results = sp.next(results)
+
+        logger.info(f"Liked songs sync for {user_id}: {len(new_rows)} new, {len(known)} cached")
+
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO liked_tracks (user_id, track_id, added_at, track) VALUES (?, ?, ?, ?)',
+                new_rows
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO liked_sync (user_id, total, skipped, synced_at) VALUES (?, ?, ?, ?)',
+                (user_id, total, skipped, time.time())
+            )
+
+        cached_count = conn.execute(
+            'SELECT COUNT(*) FROM liked_tracks WHERE user_id = ?', (user_id,)
+        ).fetchone()[0]
+        # Unusable items (local files) count toward Spotify's total but are
+        # never stored, so they're taken off before comparing. Only a surplus
+        # means something was unliked since the last sync.
+        if cached_count > total - skipped:
+            logger.info(
+                f"Cached liked songs for {user_id} out of date ({cached_count} > {total} - {skipped}), resyncing"
+            )
+            _full_liked_songs_sync(sp, user_id, progress=progress)
+        elif progress:
+            # Paging stopped at a stored track, so the rest are already cached
+            progress('fetching', fetched=total, total=total)
+
+def _full_liked_songs_sync(sp, user_id, first_page=None, progress=None):
+    """Refetch every liked song, storing each page as it arrives.
+
+    Only one page of full API tracks is held at a time. The liked_sync row
+    is written last, so an interrupted sync is redone in full next time
+    rather than mistaken for a complete one.
+    """
+    pages = iter_pages(
+        lambda offset, limit: sp.current_user_saved_tracks(limit=limit, offset=offset),
+        50,
+        first_page=first_page
+    )
+    fetched = 0
+    skipped = 0
+    with closing(connect()) as conn:
+        with conn:
+            conn.execute('DELETE FROM liked_sync WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM liked_tracks WHERE user_id = ?', (user_id,))
+        for page in pages:
+            fetched += len(page['items'])
+            total = page['total']
+            rows = [
+                (user_id, item['track']['id'], item['added_at'], track_json(item['track']))
+                for item in page['items'] if is_usable_track(item['track'])
+            ]
+            skipped += len(page['items']) - len(rows)
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO liked_tracks (user_id, track_id, added_at, track) VALUES (?, ?, ?, ?)',
+                    rows
+                )
+            if progress:
+                progress('fetching', fetched=fetched, total=total)
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO liked_sync (user_id, total, skipped, synced_at) VALUES (?, ?, ?, ?)',
+                (user_id, total, skipped, time.time())
+            )
+    logger.info(f"Fetched all {fetched} liked songs for {user_id}")
+
+def track_json(track):
+    """Serialize an API track in its compact stored form."""
+    return json.dumps(Track.from_spotify(track).to_record())
+
+def fetch_progress(progress):
+    """Adapt a stage progress callback to fetch_all_pages' on_page."""
+    if not progress:
+        return None
+    return lambda fetched, total: progress('fetching', fetched=fetched, total=total)
+
+def load_liked_songs(conn, user_id):
+    """Return the cached liked songs for a user as Tracks, newest first."""
+    rows = conn.execute(
+        'SELECT track FROM liked_tracks WHERE user_id = ? ORDER BY added_at DESC', (user_id,)
+    )
+    return [Track.from_record(json.loads(track)) for (track,) in rows]
+
+def iter_liked_songs(user_id, batch_size=500):
+    """Yield the cached liked songs as lists of (added_at, Track), newest first.
+
+    Reads from a cursor, so memory stays flat however large the library is.
+    """
+    with closing(connect()) as conn:
+        cursor = conn.execute(
+            'SELECT added_at, track FROM liked_tracks WHERE user_id = ? ORDER BY added_at DESC', (user_id,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [(added_at, Track.from_record(json.loads(track))) for added_at, track in rows]
+
+def sync_playlist(sp, user_id, playlist_id, progress=None):
+    """Return (name, tracks) for a playlist, refetching only if its snapshot changed.
+
+    Concurrent calls for the same playlist share the snapshot lookup, and
+    the refetch of the same snapshot.
+    """
+    meta = _playlist_flights.do(
+        (user_id, playlist_id), lambda: sp.playlist(playlist_id, fields='name,snapshot_id')
+    )
+
+    with closing(connect()) as conn:
+        row = conn.execute(
+            'SELECT snapshot_id FROM playlist_sync WHERE user_id = ? AND playlist_id = ?',
+            (user_id, playlist_id)
+        ).fetchone()
+        if row and row[0] == meta['snapshot_id']:
+            logger.info(f"Playlist {playlist_id} unchanged since last sync, using cache")
+            tracks = load_playlist_tracks(conn, user_id, playlist_id)
+            if progress:
+                progress('fetching', fetched=len(tracks), total=len(tracks))
+            return meta['name'], tracks
+
+    tracks = _playlist_tracks_flights.do_reporting(
+        (user_id, playlist_id, meta['snapshot_id']),
+        lambda report: _fetch_playlist(sp, user_id, playlist_id, meta, report),
+        progress,
+        retry_on=JobCancelled
+    )
+    return meta['name'], tracks
+
+def _fetch_playlist(sp, user_id, playlist_id, meta, progress=None):
+    """Fetch every track of a playlist and store them with its snapshot id."""
+    items = fetch_all_pages(
+        lambda offset, limit: sp.playlist_items(
+            playlist_id, limit=limit, offset=offset, additional_types=('track',)
+        ),
+        100,
+        on_page=fetch_progress(progress)
+    )
+    tracks = [Track.from_spotify(item['track']) for item in items if is_usable_track(item['track'])]
+
+    logger.info(f"Synced {len(tracks)} tracks for playlist {playlist_id}")
+
+    with closing(connect()) as conn:
+        with conn:
+            conn.execute(
+                'DELETE FROM playlist_tracks WHERE user_id = ? AND playlist_id = ?', (user_id, playlist_id)
+            )
+            conn.executemany(
+                'INSERT INTO playlist_tracks (user_id, playlist_id, position, track) VALUES (?, ?, ?, ?)',
+                [
+                    (user_id, playlist_id, position, json.dumps(track.to_record()))
+                    for position, track in enumerate(tracks)
+                ]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO playlist_sync (user_id, playlist_id, snapshot_id, name, synced_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (user_id, playlist_id, meta['snapshot_id'], meta['name'], time.time())
+            )
+    return tracks
+
+def load_playlist_tracks(conn, user_id, playlist_id):
+    """Return the cached tracks of a playlist as Tracks, in playlist order."""
+    rows = conn.execute(
+        'SELECT track FROM playlist_tracks WHERE user_id = ? AND playlist_id = ? ORDER BY position',
+        (user_id, playlist_id)
+    )
+    return [Track.from_record(json.loads(track)) for (track,) in rows]
@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+import math
+
+from feature_store import FEATURE_COLUMNS, feature_store
+from library_cache import iter_liked_songs
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+# Exportable track fields, read from (added_at, Track)
+TRACK_FIELDS = {
+    'id': lambda added_at, track: track.id,
+    'uri': lambda added_at, track: track.uri,
+    'name': lambda added_at, track: track.name,
+    'artists': lambda added_at, track: list(track.artist_names),
+    'artistIds': lambda added_at, track: list(track.artist_ids),
+    'album': lambda added_at, track: track.album,
+    'releaseYear': lambda added_at, track: track.release_year,
+    'popularity': lambda added_at, track: track.popularity,
+    'durationMs': lambda added_at, track: track.duration_ms,
+    'addedAt': lambda added_at, track: added_at,
+}
+DEFAULT_FIELDS = ('id', 'name', 'artists', 'album', 'addedAt')
+
+def parse_fields(fields, include_features=False):
+    """Validate a comma-separated field list; audio feature names are allowed too."""
+    names = [name.strip() for name in fields.split(',') if name.strip()] if fields else list(DEFAULT_FIELDS)
+    if include_features:
+        names += [name for name in FEATURE_COLUMNS if name not in names]
+    unknown = [name for name in names if name not in TRACK_FIELDS and name not in FEATURE_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(names))
+
+def export_rows(user_id, fields, batch_size=500):
+    """Yield one list of values per cached liked song, in `fields` order.
+
+    Audio features are joined from the feature store a batch at a time;
+    tracks without stored features get None.
+    """
+    track_fields = [(i, TRACK_FIELDS[name]) for i, name in enumerate(fields) if name in TRACK_FIELDS]
+    feature_fields = [(i, FEATURE_COLUMNS.index(name)) for i, name in enumerate(fields) if name in FEATURE_COLUMNS]
+
+    for batch in iter_liked_songs(user_id, batch_size):
+        features = feature_store.rows([track.id for _, track in batch]) if feature_fields else None
+        for row, (added_at, track) in enumerate(batch):
+            values = [None] * len(fields)
+            for i, read in track_fields:
+                values[i] = read(added_at, track)
+            for i, column in feature_fields:
+                value = float(features[row, column])
+                values[i] = None if math.isnan(value) else round(value, 4)
+            yield values
+
+def to_ndjson(fields, rows, rows_per_chunk=200):
+    lines = []
+    for values in rows:
+        lines.append(json.dumps(dict(zip(fields, values))) + '\n')
+        if len(lines) == rows_per_chunk:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+def to_csv(fields, rows, rows_per_chunk=200):
+    """CSV with a header row. List values are joined with "; "."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    count = 0
+    for values in rows:
+        writer.writerow(['; '.join(v) if isinstance(v, list) else v for v in values])
+        count += 1
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,237 @@
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import closing
+
+import numpy as np
+
+from feature_store import FEATURE_COLUMNS, feature_store
+from genre_index import artist_genres
+from library_cache import connect
+
+logger = logging.getLogger(__name__)
+
+# Distributions are reported for every audio feature plus popularity
+STAT_COLUMNS = FEATURE_COLUMNS + ('popularity',)
+# Value range of each column's histogram; the rest are on a 0-1 scale
+STAT_RANGES = {'tempo': (0.0, 250.0), 'loudness': (-60.0, 0.0), 'popularity': (0.0, 100.0)}
+# Histograms are kept this fine so percentiles can be read off them, and
+# reported with HISTOGRAM_BINS bins
+STAT_BINS = 100
+HISTOGRAM_BINS = 20
+PERCENTILES = (5, 25, 50, 75, 95)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS library_stats (
+    user_id TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    track_ids TEXT NOT NULL,
+    stats TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, source_id)
+);
+"""
+
+_LOW = np.array([STAT_RANGES.get(name, (0.0, 1.0))[0] for name in STAT_COLUMNS])
+_HIGH = np.array([STAT_RANGES.get(name, (0.0, 1.0))[1] for name in STAT_COLUMNS])
+
+_schema_ready = False
+
+def _connect():
+    global _schema_ready
+    conn = connect()
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+class LibraryStats:
+    """Aggregates over a set of tracks that can be merged without the tracks.
+
+    Everything kept is a count, a sum or a histogram, so the stats of new
+    tracks are simply added to the stored ones.
+    """
+
+    def __init__(self):
+        self.tracks = 0
+        self.duration_ms = 0
+        self.counts = np.zeros(len(STAT_COLUMNS), dtype=np.int64)
+        self.sums = np.zeros(len(STAT_COLUMNS))
+        self.squares = np.zeros(len(STAT_COLUMNS))
+        self.histograms = np.zeros((len(STAT_COLUMNS), STAT_BINS), dtype=np.int64)
+        self.decades = Counter()
+        self.artists = Counter()
+        self.artist_names = {}
+        self.genres = Counter()
+
+    @classmethod
+    def compute(cls, tracks, features, genres):
+        """Stats for `tracks` in one pass over their feature matrix.
+
+        `features` holds the feature store rows of `tracks` and `genres`
+        maps artist ids to their genres.
+        """
+        stats = cls()
+        stats.tracks = len(tracks)
+        if not tracks:
+            return stats
+        stats.duration_ms = sum(track.duration_ms for track in tracks)
+
+        popularity = np.fromiter((track.popularity for track in tracks), dtype=np.float64, count=len(tracks))
+        values = np.column_stack([np.asarray(features, dtype=np.float64), popularity])
+        valid = ~np.isnan(values)
+        stats.counts = valid.sum(axis=0)
+        stats.sums = np.where(valid, values, 0).sum(axis=0)
+        stats.squares = np.where(valid, values ** 2, 0).sum(axis=0)
+
+        # Bin every value at once, offsetting each column into its own block
+        scaled = (np.where(valid, values, _LOW) - _LOW) / (_HIGH - _LOW) * STAT_BINS
+        bins = np.clip(np.floor(scaled), 0, STAT_BINS - 1).astype(np.int64) + np.arange(len(STAT_COLUMNS)) * STAT_BINS
+        stats.histograms = np.bincount(bins[valid], minlength=len(STAT_COLUMNS) * STAT_BINS).reshape(
+            len(STAT_COLUMNS), STAT_BINS
+        )
+
+        years = np.fromiter((track.release_year or 0 for track in tracks), dtype=np.int64, count=len(tracks))
+        decades, counts = np.unique(years[years > 0] // 10 * 10, return_counts=True)
+        stats.decades = Counter(dict(zip(decades.tolist(), counts.tolist())))
+
+        for track in tracks:
+            stats.artists.update(set(track.artist_ids))
+            stats.artist_names.update(zip(track.artist_ids, track.artist_names))
+            stats.genres.update({genre for artist_id in track.artist_ids for genre in genres.get(artist_id, ())})
+        return stats
+
+    def merge(self, other):
+        self.tracks += other.tracks
+        self.duration_ms += other.duration_ms
+        self.counts = self.counts + other.counts
+        self.sums = self.sums + other.sums
+        self.squares = self.squares + other.squares
+        self.histograms = self.histograms + other.histograms
+        self.decades.update(other.decades)
+        self.artists.update(other.artists)
+        self.artist_names.update(other.artist_names)
+        self.genres.update(other.genres)
+        return self
+
+    def to_record(self):
+        """A JSON-serializable dict, the form stored in the library store."""
+        return {
+            "tracks": self.tracks,
+            "durationMs": self.duration_ms,
+            "columns": list(STAT_COLUMNS),
+            "counts": self.counts.tolist(),
+            "sums": self.sums.tolist(),
+            "squares": self.squares.tolist(),
+            "histograms": self.histograms.tolist(),
+            "decades": [[decade, count] for decade, count in self.decades.items()],
+            "artists": self.artists,
+            "artistNames": self.artist_names,
+            "genres": self.genres,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """Inverse of to_record, or None if it was stored with other columns."""
+        if record.get('columns') != list(STAT_COLUMNS):
+            return None
+        stats = cls()
+        stats.tracks = record['tracks']
+        stats.duration_ms = record['durationMs']
+        stats.counts = np.array(record['counts'], dtype=np.int64)
+        stats.sums = np.array(record['sums'])
+        stats.squares = np.array(record['squares'])
+        stats.histograms = np.array(record['histograms'], dtype=np.int64)
+        stats.decades = Counter({decade: count for decade, count in record['decades']})
+        stats.artists = Counter(record['artists'])
+        stats.artist_names = record['artistNames']
+        stats.genres = Counter(record['genres'])
+        return stats
+
+    def percentiles(self, column):
+        """Percentiles of a column, interpolated within histogram bins."""
+        histogram = self.histograms[column]
+        cumulative = np.cumsum(histogram)
+        if cumulative[-1] == 0:
+            return {f"p{q}": None for q in PERCENTILES}
+        width = (_HIGH[column] - _LOW[column]) / STAT_BINS
+        result = {}
+        for q in PERCENTILES:
+            rank = q / 100 * cumulative[-1]
+            i = min(int(np.searchsorted(cumulative, rank)), STAT_BINS - 1)
+            below = cumulative[i] - histogram[i]
+            fraction = (rank - below) / histogram[i] if histogram[i] else 0.0
+            result[f"p{q}"] = round(float(_LOW[column] + (i + fraction) * width), 4)
+        return result
+
+    def to_dict(self, top=20):
+        features = {}
+        for column, name in enumerate(STAT_COLUMNS):
+            count = int(self.counts[column])
+            mean = self.sums[column] / count if count else None
+            std = np.sqrt(max(self.squares[column] / count - mean ** 2, 0.0)) if count else None
+            features[name] = {
+                "count": count,
+                "mean": None if mean is None else round(float(mean), 4),
+                "std": None if std is None else round(float(std), 4),
+                "percentiles": self.percentiles(column),
+                "histogram": {
+                    "min": float(_LOW[column]),
+                    "max": float(_HIGH[column]),
+                    "counts": self.histograms[column].reshape(HISTOGRAM_BINS, -1).sum(axis=1).tolist()
+                }
+            }
+        return {
+            "tracks": self.tracks,
+            "durationMs": self.duration_ms,
+            "features": features,
+            "decades": [{"decade": decade, "tracks": count} for decade, count in sorted(self.decades.items())],
+            "unknownYear": self.tracks - sum(self.decades.values()),
+            "topArtists": [
+                {"id": artist_id, "name": self.artist_names.get(artist_id), "tracks": count}
+                for artist_id, count in self.artists.most_common(top)
+            ],
+            "topGenres": [{"genre": genre, "tracks": count} for genre, count in self.genres.most_common(top)]
+        }
+
+def _compute(sp, tracks):
+    track_ids = [track.id for track in tracks]
+    feature_store.ensure(sp, track_ids)
+    genres = artist_genres(sp, [artist_id for track in tracks for artist_id in track.artist_ids])
+    return LibraryStats.compute(tracks, feature_store.rows(track_ids), genres)
+
+def library_stats(sp, user_id, source_id, tracks):
+    """Stats for a source's current tracks, updating the stored ones.
+
+    Stats are stored per source along with the track ids they cover. Tracks
+    added since are computed on their own and merged in; if any were
+    removed the stats are recomputed, since histograms can't forget a track.
+    """
+    current = list({track.id: track for track in tracks}.values())
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            'SELECT track_ids, stats FROM library_stats WHERE user_id = ? AND source_id = ?',
+            (user_id, source_id)
+        ).fetchone()
+        stored_ids = set(json.loads(row[0])) if row else set()
+        stats = LibraryStats.from_record(json.loads(row[1])) if row else None
+
+        current_ids = {track.id for track in current}
+        if stats is not None and stored_ids <= current_ids:
+            added = [track for track in current if track.id not in stored_ids]
+            if not added:
+                return stats
+            stats.merge(_compute(sp, added))
+            logger.info(f"Library stats for {source_id}: merged {len(added)} new tracks")
+        else:
+            stats = _compute(sp, current)
+            logger.info(f"Library stats for {source_id}: computed for {len(current)} tracks")
+
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO library_stats (user_id, source_id, track_ids, stats, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (user_id, source_id, json.dumps(sorted(current_ids)), json.dumps(stats.to_record()), time.time())
+            )
+    return stats
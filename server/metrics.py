@@ -0,0 +1,215 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+import urllib3
+
+# Latency buckets in seconds, from a cached lookup to a full library sync
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    """Renders as its HELP and TYPE lines followed by its samples."""
+
+    kind = 'untyped'
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self, extra=()):
+        return self.header() + self.samples(extra)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self, extra=()):
+        """Sample lines, with `extra` (name, value) label pairs added to each."""
+        with self._lock:
+            return [
+                f'{self.name}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}'
+                for labels, value in sorted(self._values.items())
+            ]
+
+class Gauge(Metric):
+    """A value read from a callback when metrics are scraped."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self, extra=()):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}'
+            for labels, value in self.collect() if value is not None
+        ]
+
+class CollectedCounter(Gauge):
+    """A counter read from a callback, for totals kept elsewhere such as cache hits."""
+
+    kind = 'counter'
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self, extra=()):
+        extra = list(extra)
+        lines = []
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    le = _format_labels(self.labelnames, labels, extra + [('le', _format_value(bound))])
+                    lines.append(f'{self.name}_bucket{le} {count}')
+                inf = _format_labels(self.labelnames, labels, extra + [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{inf} {series["count"]}')
+                base = _format_labels(self.labelnames, labels, extra)
+                lines.append(f'{self.name}_sum{base} {_format_value(series["sum"])}')
+                lines.append(f'{self.name}_count{base} {series["count"]}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def samples(self, extra=()):
+        """{metric name: sample lines} for every metric, e.g. to publish to other processes."""
+        return {metric.name: metric.samples(extra) for metric in self._metrics}
+
+    def render(self, snapshots=None):
+        """The Prometheus text exposition of every metric.
+
+        `snapshots` are samples() taken in several processes, rendered
+        together under each metric's header; by default this process's own.
+        """
+        snapshots = [self.samples()] if snapshots is None else snapshots
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            for samples in snapshots:
+                lines.extend(samples.get(metric.name, ()))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'playlist_generator_stage_seconds', 'Time spent in each stage of playlist generation', ['stage']
+))
+spotify_requests = registry.register(Counter(
+    'spotify_requests_total', 'Outbound Spotify API calls by endpoint and final status', ['endpoint', 'method', 'status']
+))
+spotify_request_seconds = registry.register(Histogram(
+    'spotify_request_seconds', 'Latency of outbound Spotify API calls, including retries',
+    ['endpoint', 'method', 'status']
+))
+spotify_retries = registry.register(Counter(
+    'spotify_retries_total', 'Spotify API responses that were retried, e.g. 429s', ['endpoint', 'status']
+))
+
+# Stage timings of the request being handled, for Server-Timing
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def start_request_timings():
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+def request_timings():
+    return _request_timings.get()
+
+@contextmanager
+def stage(name):
+    """Time a block as a pipeline stage, in the histogram and for this request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+def server_timing_header(timings):
+    """Format (stage, seconds) pairs as a Server-Timing header value."""
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings)
+
+# Path segments following these are ids and get collapsed into {id}
+ID_PARENTS = {'users', 'playlists', 'artists', 'albums', 'tracks', 'audio-analysis', 'episodes', 'shows'}
+
+def endpoint_label(url):
+    """Turn an API URL into a low-cardinality label, e.g. /playlists/{id}/tracks."""
+    path = urllib3.util.parse_url(url).path or '/'
+    segments = [s for s in path.split('/') if s]
+    if segments and segments[0] == 'v1':
+        segments = segments[1:]
+    labelled = [
+        '{id}' if i > 0 and segments[i - 1] in ID_PARENTS else segment
+        for i, segment in enumerate(segments)
+    ]
+    return '/' + '/'.join(labelled)
+
+class InstrumentedSession(requests.Session):
+    """A session that records count and latency of every request it sends."""
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_label(url)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            spotify_request_seconds.observe(time.perf_counter() - start, endpoint, method, status)
+            spotify_requests.inc(endpoint, method, status)
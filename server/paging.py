@@ -0,0 +1,134 @@
+import contextvars
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Number of pages requested at once. Keep this low enough to stay under
+# Spotify's rate limit when several users sync at the same time.
+SPOTIFY_FETCH_CONCURRENCY = int(os.environ.get('SPOTIFY_FETCH_CONCURRENCY', 4))
+PAGE_RETRIES = int(os.environ.get('SPOTIFY_PAGE_RETRIES', 3))
+
+def fetch_all_pages(fetch_page, limit, first_page=None, max_workers=None, retries=PAGE_RETRIES, on_page=None):
+    """Fetch every item of an offset-paged Spotify collection.
+
+    `fetch_page(offset, limit)` must return a Spotify paging object. The first
+    page tells us `total`, so all remaining offsets are requested concurrently
+    instead of following `next` one page at a time. Items are returned in
+    collection order. `on_page(fetched, total)` is called as pages arrive.
+    """
+    items = []
+    pages = 0
+    for page in iter_pages(fetch_page, limit, first_page, max_workers, retries):
+        items.extend(page['items'])
+        pages += 1
+        if on_page:
+            on_page(len(items), page['total'])
+
+    logger.info(f"Fetched {len(items)} items in {pages} pages")
+    return items
+
+def iter_pages(fetch_page, limit, first_page=None, max_workers=None, retries=PAGE_RETRIES):
+    """Yield the pages of an offset-paged collection in order, as they arrive.
+
+    Like fetch_all_pages, but nothing is accumulated, so callers can stream
+    items out while later pages are still in flight. Closing the generator
+    early cancels the pages not yet requested.
+    """
+    if first_page is None:
+        first_page = fetch_page(0, limit)
+    yield first_page
+
+    offsets = range(limit, first_page['total'], limit)
+    if not offsets:
+        return
+
+    workers = max(1, min(max_workers or SPOTIFY_FETCH_CONCURRENCY, len(offsets)))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    offsets = iter(offsets)
+
+    def submit(offset):
+        # Each page runs in a copy of the caller's context, so it keeps the
+        # caller's rate limit priority
+        context = contextvars.copy_context()
+        pending.append(pool.submit(context.run, fetch_page_with_retry, fetch_page, offset, limit, retries))
+
+    try:
+        # Keep only a couple of pages per worker in flight, so a slow
+        # consumer doesn't end up holding every fetched page in memory
+        for offset in itertools.islice(offsets, workers * 2):
+            submit(offset)
+        while pending:
+            page = pending.popleft().result()
+            for offset in itertools.islice(offsets, 1):
+                submit(offset)
+            yield page
+    finally:
+        # If a page failed for good or the caller stopped, don't fetch the rest
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def iter_batches(fetch_batch, items, batch_size, max_workers=None, retries=PAGE_RETRIES):
+    """Yield `fetch_batch(batch)` for each batch of `items`, in order, as they arrive.
+
+    For calls that take a list of ids instead of an offset, e.g. audio
+    features or artists. Batches are requested concurrently and retried like
+    pages. Closing the generator early cancels the batches not yet started.
+    """
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    if not batches:
+        return
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers or SPOTIFY_FETCH_CONCURRENCY, len(batches))))
+    try:
+        # Batches run in copies of the caller's context, so they keep the
+        # caller's rate limit priority
+        results = [
+            pool.submit(
+                contextvars.copy_context().run,
+                fetch_page_with_retry, lambda offset, limit, batch=batch: fetch_batch(batch), 0, len(batch), retries
+            )
+            for batch in batches
+        ]
+        for result in results:
+            yield result.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def fetch_page_with_retry(fetch_page, offset, limit, retries=PAGE_RETRIES):
+    """Fetch a single page, retrying with backoff when it fails.
+
+    Only dropped connections, timeouts and 5xx responses are retried here.
+    429s are already retried by the session, which pauses every caller for
+    the rate limit, so they and the scheduler's RateLimited fail straight away.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fetch_page(offset, limit)
+        except Exception as e:
+            attempt += 1
+            if attempt > retries or not is_retryable(e):
+                raise
+            delay = retry_delay(attempt)
+            logger.warning(f"Page at offset {offset} failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def is_retryable(error):
+    """Whether a failed page is worth asking for again: transport errors and 5xx."""
+    status = getattr(error, 'http_status', None)
+    if status is not None:
+        return status >= 500
+    return isinstance(error, (
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError
+    ))
+
+def retry_delay(attempt):
+    """Seconds to wait before the next attempt."""
+    return 0.5 * 2 ** (attempt - 1)
@@ -0,0 +1,312 @@
+import bisect
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from library_cache import connect
+from paging import fetch_all_pages
+
+logger = logging.getLogger(__name__)
+
+ADD_ITEMS_BATCH_SIZE = 100  # Spotify's limit for one playlist_add_items call
+# Playlists written at the same time; batches within one playlist stay sequential
+PLAYLIST_WRITE_WORKERS = int(os.environ.get('PLAYLIST_WRITE_WORKERS', 4))
+# An in-place update is sent as a diff when it takes at most this many calls
+# (or no more than rewriting the playlist). Diffs keep the added dates of
+# unchanged tracks, so they're preferred even when a rewrite is a call shorter.
+MAX_DIFF_CALLS = int(os.environ.get('MAX_DIFF_CALLS', 10))
+# Finished write records are dropped after this long
+WRITE_RETENTION_SECONDS = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlist_writes (
+    write_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    uris TEXT NOT NULL,
+    start_position INTEGER NOT NULL,
+    committed_batches INTEGER NOT NULL,
+    snapshot_id TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+class PlaylistWriteError(Exception):
+    """A write stopped part way. `write_id` can be passed to resume_write."""
+
+    def __init__(self, message, write_id, playlist_id):
+        super().__init__(message)
+        self.write_id = write_id
+        self.playlist_id = playlist_id
+
+_schema_ready = False
+
+def _connect():
+    global _schema_ready
+    conn = connect()
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+def write_playlist(sp, user_id, playlist_id, uris, start_position=0, progress=None):
+    """Add `uris` to a playlist in batches, recording each committed batch.
+
+    Every batch is inserted at an explicit position, so the final order is
+    the order of `uris` no matter how writes are scheduled. If a batch fails
+    the write is left resumable under its write id (see resume_write).
+    Returns the final snapshot id.
+    """
+    write_id = uuid.uuid4().hex
+    with closing(_connect()) as conn:
+        with conn:
+            conn.execute(
+                'DELETE FROM playlist_writes WHERE status = ? AND updated_at < ?',
+                ('done', time.time() - WRITE_RETENTION_SECONDS)
+            )
+            conn.execute(
+                'INSERT INTO playlist_writes (write_id, user_id, playlist_id, uris, start_position, '
+                'committed_batches, snapshot_id, status, updated_at) VALUES (?, ?, ?, ?, ?, 0, NULL, ?, ?)',
+                (write_id, user_id, playlist_id, json.dumps(uris), start_position, 'pending', time.time())
+            )
+    return _run_write(sp, write_id, playlist_id, uris, start_position, 0, progress)
+
+def resume_write(sp, user_id, write_id, progress=None):
+    """Continue an interrupted write from its last committed batch.
+
+    The playlist's current length is checked first: if the batch in flight
+    when the write stopped did land, it's counted as committed instead of
+    being added twice. Any other change to the playlist is reported as an
+    error rather than guessed at.
+    """
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            'SELECT playlist_id, uris, start_position, committed_batches, status FROM playlist_writes '
+            'WHERE write_id = ? AND user_id = ?',
+            (write_id, user_id)
+        ).fetchone()
+    if not row:
+        raise KeyError(write_id)
+    playlist_id, uris, start_position, committed, status = row
+    uris = json.loads(uris)
+    if status == 'done':
+        return None
+
+    committed_items = min(committed * ADD_ITEMS_BATCH_SIZE, len(uris))
+    actual = sp.playlist(playlist_id, fields='tracks.total')['tracks']['total']
+    in_flight = len(uris[committed_items:committed_items + ADD_ITEMS_BATCH_SIZE])
+    if actual == start_position + committed_items + in_flight and in_flight:
+        logger.info(f"Batch {committed} of write {write_id} landed before the failure, skipping it")
+        committed += 1
+    elif actual != start_position + committed_items:
+        raise PlaylistWriteError(
+            f"Playlist {playlist_id} has {actual} items, expected {start_position + committed_items}; "
+            "it was changed since the write stopped",
+            write_id, playlist_id
+        )
+
+    logger.info(f"Resuming write {write_id} to {playlist_id} at batch {committed}")
+    return _run_write(sp, write_id, playlist_id, uris, start_position, committed, progress)
+
+def _run_write(sp, write_id, playlist_id, uris, start_position, committed, progress):
+    snapshot_id = None
+    batches = range(committed * ADD_ITEMS_BATCH_SIZE, len(uris), ADD_ITEMS_BATCH_SIZE)
+    with closing(_connect()) as conn:
+        for batch_number, i in enumerate(batches, start=committed):
+            batch = uris[i:i + ADD_ITEMS_BATCH_SIZE]
+            try:
+                response = sp.playlist_add_items(playlist_id, batch, position=start_position + i)
+                snapshot_id = (response or {}).get('snapshot_id')
+                if not snapshot_id:
+                    raise ValueError(f"no snapshot_id in response: {response!r}")
+            except Exception as e:
+                with conn:
+                    conn.execute(
+                        'UPDATE playlist_writes SET status = ?, updated_at = ? WHERE write_id = ?',
+                        ('failed', time.time(), write_id)
+                    )
+                logger.error(f"Write {write_id} to {playlist_id} failed at batch {batch_number}: {str(e)}")
+                raise PlaylistWriteError(
+                    f"Adding tracks to playlist {playlist_id} failed after {i} of {len(uris)}: {str(e)}",
+                    write_id, playlist_id
+                ) from e
+
+            with conn:
+                conn.execute(
+                    'UPDATE playlist_writes SET committed_batches = ?, snapshot_id = ?, updated_at = ? '
+                    'WHERE write_id = ?',
+                    (batch_number + 1, snapshot_id, time.time(), write_id)
+                )
+            if progress:
+                progress('writing', added=i + len(batch), total=len(uris))
+
+        with conn:
+            conn.execute(
+                'UPDATE playlist_writes SET status = ?, updated_at = ? WHERE write_id = ?',
+                ('done', time.time(), write_id)
+            )
+    return snapshot_id
+
+def write_playlists(sp, user_id, writes, max_workers=PLAYLIST_WRITE_WORKERS):
+    """Write several playlists at once.
+
+    `writes` is a list of (playlist_id, uris). Different playlists are
+    written concurrently. Returns one dict per write, in order, with either
+    `snapshotId` or `error` and `writeId` for resuming.
+    """
+    def run(write):
+        playlist_id, uris = write
+        try:
+            return {"playlistId": playlist_id, "snapshotId": write_playlist(sp, user_id, playlist_id, uris)}
+        except PlaylistWriteError as e:
+            return {"playlistId": playlist_id, "error": str(e), "writeId": e.write_id}
+
+    if len(writes) <= 1:
+        return [run(write) for write in writes]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(writes))) as pool:
+        return list(pool.map(run, writes))
+
+def plan_playlist_update(current, target):
+    """Work out the edits that turn the `current` uri list into `target`.
+
+    Returns (removals, moves, inserts): uris to remove; (range_start,
+    range_length, insert_before) reorders to apply in order after the
+    removals; and (position, uris) runs to insert in order after that.
+    Tracks in the longest run already in target order stay where they are,
+    so a refresh that changed little needs few calls.
+    """
+    target_index = {uri: i for i, uri in enumerate(target)}
+    removals = list(dict.fromkeys(uri for uri in current if uri not in target_index))
+    kept = [uri for uri in current if uri in target_index]
+
+    # Longest increasing subsequence of target positions among kept tracks
+    tails, tail_rows, previous = [], [], [None] * len(kept)
+    for row, uri in enumerate(kept):
+        position = target_index[uri]
+        i = bisect.bisect_left(tails, position)
+        if i == len(tails):
+            tails.append(position)
+            tail_rows.append(row)
+        else:
+            tails[i] = position
+            tail_rows[i] = row
+        previous[row] = tail_rows[i - 1] if i else None
+    anchors = set()
+    row = tail_rows[-1] if tail_rows else None
+    while row is not None:
+        anchors.add(kept[row])
+        row = previous[row]
+
+    # Put every other kept track right after its predecessor in target order,
+    # moving runs that are already together in one call
+    ordered = sorted(kept, key=target_index.__getitem__)
+    current_order = list(kept)
+    moves = []
+    i = 0
+    while i < len(ordered):
+        if ordered[i] in anchors:
+            i += 1
+            continue
+        start = current_order.index(ordered[i])
+        length = 1
+        while (i + length < len(ordered) and ordered[i + length] not in anchors
+               and start + length < len(current_order) and current_order[start + length] == ordered[i + length]):
+            length += 1
+        before = current_order.index(ordered[i - 1]) + 1 if i else 0
+        if before != start:
+            block = current_order[start:start + length]
+            del current_order[start:start + length]
+            at = before if before <= start else before - length
+            current_order[at:at] = block
+            moves.append((start, length, before))
+        i += length
+
+    # New tracks go in as runs at their final positions, left to right
+    kept_uris = set(kept)
+    inserts = []
+    for position, uri in enumerate(target):
+        if uri in kept_uris:
+            continue
+        if inserts and inserts[-1][0] + len(inserts[-1][1]) == position:
+            inserts[-1][1].append(uri)
+        else:
+            inserts.append((position, [uri]))
+    return removals, moves, inserts
+
+def update_playlist(sp, playlist_id, uris, progress=None):
+    """Make an existing playlist hold `uris`, in order, with as few calls as possible.
+
+    The current contents are diffed against `uris` and only the needed
+    removals, reorders and inserts are sent. Each call carries the snapshot
+    id from the one before, starting from the snapshot that was read. If the
+    diff would take more than MAX_DIFF_CALLS calls and more than rewriting
+    the playlist, or the playlist has duplicates or local files, its items
+    are replaced instead. Running an interrupted
+    update again recomputes the diff and finishes it. The playlist keeps its
+    name, which is returned with the counts of what changed.
+    """
+    first = sp.playlist(playlist_id, fields='name,snapshot_id,tracks(total,items(track(uri)))')
+    items = fetch_all_pages(
+        lambda offset, limit: sp.playlist_items(playlist_id, fields='total,items(track(uri))', limit=limit, offset=offset),
+        100,
+        first_page=first['tracks']
+    )
+    # Local files and unavailable tracks have no uri we could re-add, but
+    # they still take up positions
+    current = [(item.get('track') or {}).get('uri') for item in items]
+    snapshot_id = first['snapshot_id']
+
+    removals, moves, inserts = plan_playlist_update(current, uris)
+    diff_calls = -(-len(removals) // ADD_ITEMS_BATCH_SIZE) + len(moves) + sum(
+        -(-len(run) // ADD_ITEMS_BATCH_SIZE) for _, run in inserts
+    )
+    replace_calls = max(1, -(-len(uris) // ADD_ITEMS_BATCH_SIZE))
+    summary = {
+        "name": first.get('name'),
+        "added": sum(len(run) for _, run in inserts),
+        "removed": len(removals),
+        "moved": len(moves)
+    }
+
+    if None in current or len(set(current)) != len(current) or diff_calls > max(replace_calls, MAX_DIFF_CALLS):
+        logger.info(f"Replacing {playlist_id} ({replace_calls} calls) instead of diffing ({diff_calls} calls)")
+        snapshot_id = sp.playlist_replace_items(playlist_id, uris[:ADD_ITEMS_BATCH_SIZE])['snapshot_id']
+        if progress:
+            progress('writing', calls=1, total=replace_calls)
+        for i in range(ADD_ITEMS_BATCH_SIZE, len(uris), ADD_ITEMS_BATCH_SIZE):
+            snapshot_id = sp.playlist_add_items(playlist_id, uris[i:i + ADD_ITEMS_BATCH_SIZE], position=i)['snapshot_id']
+            if progress:
+                progress('writing', calls=i // ADD_ITEMS_BATCH_SIZE + 1, total=replace_calls)
+        return {"snapshotId": snapshot_id, "mode": "replace", "calls": replace_calls, **summary}
+
+    done = 0
+    for i in range(0, len(removals), ADD_ITEMS_BATCH_SIZE):
+        snapshot_id = sp.playlist_remove_all_occurrences_of_items(
+            playlist_id, removals[i:i + ADD_ITEMS_BATCH_SIZE], snapshot_id=snapshot_id
+        )['snapshot_id']
+        done += 1
+        if progress:
+            progress('writing', calls=done, total=diff_calls)
+    for start, length, before in moves:
+        snapshot_id = sp.playlist_reorder_items(
+            playlist_id, start, before, range_length=length, snapshot_id=snapshot_id
+        )['snapshot_id']
+        done += 1
+        if progress:
+            progress('writing', calls=done, total=diff_calls)
+    for position, run in inserts:
+        for i in range(0, len(run), ADD_ITEMS_BATCH_SIZE):
+            snapshot_id = sp.playlist_add_items(
+                playlist_id, run[i:i + ADD_ITEMS_BATCH_SIZE], position=position + i
+            )['snapshot_id']
+            done += 1
+            if progress:
+                progress('writing', calls=done, total=diff_calls)
+
+    logger.info(f"Updated {playlist_id} in {diff_calls} calls: {summary}")
+    return {"snapshotId": snapshot_id, "mode": "diff", "calls": diff_calls, **summary}
@@ -0,0 +1,133 @@
+# Keyword tables used to interpret free-text prompts. Shared by prompt
+# parsing, where they map words to genres and audio feature targets, and by
+# clustering, where they turn cluster centroids back into words.
+
+# List of common music genres
+COMMON_GENRES = [
+    'rock', 'pop', 'hip hop', 'rap', 'jazz', 'blues', 'country', 'metal',
+    'folk', 'electronic', 'dance', 'r&b', 'soul', 'funk', 'disco', 'classical',
+    'reggae', 'punk', 'indie', 'alternative', 'techno', 'house', 'ambient',
+    'edm', 'trap', 'lo-fi', 'instrumental', 'acoustic', 'soundtrack',
+    # Add more specific subgenres for better matching
+    'indie rock', 'indie pop', 'dream pop', 'synthwave', 'vaporwave',
+    'post-rock', 'shoegaze', 'chillwave', 'trip hop', 'downtempo',
+    'deep house', 'tech house', 'progressive house', 'electro swing',
+    'nu jazz', 'acid jazz', 'smooth jazz', 'bebop', 'hard bop',
+    'alt rock', 'grunge', 'post-punk', 'new wave', 'synth-pop',
+    'bedroom pop', 'hyperpop', 'alt-pop', 'art pop', 'baroque pop',
+    'alt-country', 'americana', 'bluegrass', 'folk rock', 'singer-songwriter'
+]
+
+# Map keywords to potential genres, used when the prompt names no genre
+KEYWORD_TO_GENRE = {
+    # Moods
+    'energetic': 'dance',
+    'party': 'pop',
+    'workout': 'electronic',
+    'study': 'ambient',
+    'relax': 'chill',
+    'relaxing': 'chill',
+    'calm': 'ambient',
+    'peaceful': 'ambient',
+    'sad': 'blues',
+    'melancholy': 'indie',
+    'happy': 'pop',
+    'upbeat': 'pop',
+    'angry': 'rock',
+    'intense': 'metal',
+    'romantic': 'r&b',
+    'sensual': 'r&b',
+    'focus': 'instrumental',
+    'sleep': 'ambient',
+    'dreamy': 'dream pop',
+    'nostalgic': 'indie',
+    'retro': 'synthwave',
+
+    # Activities
+    'driving': 'rock',
+    'road trip': 'rock',
+    'dinner': 'jazz',
+    'morning': 'pop',
+    'night': 'electronic',
+    'late night': 'downtempo',
+    'dancing': 'dance',
+    'running': 'electronic',
+    'gym': 'hip hop',
+    'coding': 'lo-fi',
+    'reading': 'classical',
+    'meditation': 'ambient',
+    'yoga': 'ambient',
+    'beach': 'reggae',
+    'summer': 'pop',
+    'winter': 'indie',
+    'autumn': 'folk',
+    'spring': 'indie pop',
+    'rain': 'ambient',
+    'sunset': 'chill',
+    'sunrise': 'ambient',
+
+    # Decades
+    '80s': 'synthwave',
+    '90s': 'alternative',
+    '70s': 'rock',
+    '60s': 'rock',
+    '2000s': 'pop',
+
+    # Descriptors
+    'chill': 'lo-fi',
+    'smooth': 'r&b',
+    'heavy': 'metal',
+    'soft': 'acoustic',
+    'acoustic': 'acoustic',
+    'instrumental': 'instrumental',
+    'vocal': 'pop',
+    'electronic': 'electronic',
+    'experimental': 'alternative',
+    'cinematic': 'soundtrack',
+    'epic': 'soundtrack',
+    'atmospheric': 'ambient',
+    'groovy': 'funk',
+    'funky': 'funk',
+    'soulful': 'soul',
+    'jazzy': 'jazz',
+    'bluesy': 'blues',
+    'folky': 'folk',
+    'indie': 'indie',
+    'alternative': 'alternative',
+    'punk': 'punk',
+    'rock': 'rock',
+    'pop': 'pop',
+    'hip hop': 'hip hop',
+    'rap': 'rap',
+    'classical': 'classical',
+    'orchestral': 'classical'
+}
+
+# Words that push an audio feature target up or down, per feature. The first
+# word of each list is the one used when describing a cluster.
+FEATURE_KEYWORDS = {
+    'energy': (
+        ['energetic', 'upbeat', 'party', 'workout', 'intense', 'dance', 'dancing'],
+        ['calm', 'relaxing', 'chill', 'peaceful', 'sleep', 'ambient', 'meditation'],
+    ),
+    'danceability': (
+        ['dance', 'dancing', 'party', 'groove', 'groovy', 'funky'],
+        [],
+    ),
+    'valence': (
+        ['happy', 'upbeat', 'positive', 'cheerful', 'joy'],
+        ['sad', 'melancholy', 'depressing', 'somber', 'dark'],
+    ),
+    'acousticness': (
+        ['acoustic', 'unplugged', 'folk', 'singer-songwriter'],
+        ['electronic', 'synth', 'edm', 'produced'],
+    ),
+    'instrumentalness': (
+        ['instrumental', 'no vocals', 'no singing', 'background'],
+        ['vocals', 'singing', 'vocal', 'lyrics'],
+    ),
+    'tempo': (
+        ['fast', 'upbeat', 'energetic', 'workout'],
+        ['slow', 'relaxing', 'chill', 'ballad'],
+    ),
+}
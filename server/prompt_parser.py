@@ -0,0 +1,83 @@
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+from prompt_keywords import COMMON_GENRES, FEATURE_KEYWORDS, KEYWORD_TO_GENRE
+
+PROMPT_CACHE_SIZE = int(os.environ.get('PROMPT_CACHE_SIZE', 1024))
+
+# How far a keyword moves each feature target. Tempo is in BPM.
+FEATURE_STEPS = {'tempo': 20}
+DEFAULT_FEATURE_STEP = 0.3
+
+ParsedPrompt = namedtuple('ParsedPrompt', ['genres', 'feature_deltas', 'named_genres'])
+
+def normalize(text):
+    """Lowercase, treat hyphens as spaces and collapse whitespace."""
+    return ' '.join(text.lower().replace('-', ' ').split())
+
+def _build_phrase_table():
+    """Map every normalized keyword to what it means for a prompt.
+
+    Each entry holds the genre it names (if any), the genre it implies when
+    the prompt names none, and the feature directions it pushes.
+    """
+    table = {}
+
+    def entry(phrase):
+        return table.setdefault(normalize(phrase), {'genre': None, 'implies': None, 'features': []})
+
+    for genre in COMMON_GENRES:
+        entry(genre)['genre'] = genre
+    for keyword, genre in KEYWORD_TO_GENRE.items():
+        entry(keyword)['implies'] = genre
+    for feature, (up_words, down_words) in FEATURE_KEYWORDS.items():
+        for word in up_words:
+            entry(word)['features'].append((feature, 1))
+        for word in down_words:
+            entry(word)['features'].append((feature, -1))
+    return table
+
+PHRASES = _build_phrase_table()
+
+# One alternation over every keyword, longest first so "deep house" wins over
+# "house" and "no vocals" over "vocals". The lookarounds only allow matches on
+# whole words, so "rap" doesn't match inside "trap" or "rapid".
+PROMPT_PATTERN = re.compile(
+    r'(?<!\w)(?:' + '|'.join(re.escape(p) for p in sorted(PHRASES, key=len, reverse=True)) + r')(?!\w)'
+)
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _parse_normalized(normalized_prompt):
+    genres = []
+    implied_genres = []
+    directions = {}
+
+    for match in PROMPT_PATTERN.finditer(normalized_prompt):
+        phrase = PHRASES[match.group(0)]
+        if phrase['genre'] and phrase['genre'] not in genres:
+            genres.append(phrase['genre'])
+        if phrase['implies'] and phrase['implies'] not in implied_genres:
+            implied_genres.append(phrase['implies'])
+        for feature, direction in phrase['features']:
+            # Raising keywords take precedence over lowering ones
+            directions[feature] = max(directions.get(feature, direction), direction)
+
+    feature_deltas = {
+        feature: direction * FEATURE_STEPS.get(feature, DEFAULT_FEATURE_STEP)
+        for feature, direction in directions.items()
+    }
+    return ParsedPrompt(tuple(genres or implied_genres), MappingProxyType(feature_deltas), tuple(genres))
+
+def parse_prompt(prompt):
+    """Read genres and audio feature adjustments from a prompt in one pass.
+
+    Genres named in the prompt are returned in the order they appear; if
+    there are none, genres implied by mood and activity words are used
+    instead; `named_genres` holds only the named ones. `feature_deltas` maps
+    feature names to how far their target should move. Results are cached
+    by normalized prompt and must not be modified.
+    """
+    return _parse_normalized(normalize(prompt))
@@ -0,0 +1,43 @@
+import numpy as np
+
+from feature_store import COLUMN_INDEX
+
+# How much each feature counts towards a track's distance from the target
+FEATURE_WEIGHTS = {
+    'danceability': 1.0,
+    'energy': 1.0,
+    'valence': 1.0,
+    'acousticness': 0.75,
+    'instrumentalness': 0.75,
+    'tempo': 0.5,
+}
+
+# Divisors that bring each feature onto a 0-1 scale before weighting
+FEATURE_SCALES = {'tempo': 200.0}
+
+def rank_by_target(features, target_features, top_n, weights=None):
+    """Return the rows of `features` closest to the target, best first.
+
+    `target_features` uses the recommendation parameter names
+    (`target_energy`, ...). Every track is scored with one weighted squared
+    distance over the feature columns the target sets; tracks without
+    features sort last. Ties are broken by row so the result is deterministic.
+    """
+    weights = weights or FEATURE_WEIGHTS
+    names = [name for name in weights if f'target_{name}' in target_features]
+    if not names or len(features) == 0:
+        return np.arange(min(top_n, len(features)))
+
+    columns = [COLUMN_INDEX[name] for name in names]
+    scale = np.array([FEATURE_SCALES.get(name, 1.0) for name in names], dtype=np.float32)
+    target = np.array([target_features[f'target_{name}'] for name in names], dtype=np.float32)
+    weight = np.array([weights[name] for name in names], dtype=np.float32)
+
+    diff = (np.asarray(features[:, columns]) - target) / scale
+    scores = (weight * diff ** 2).sum(axis=1)
+    scores[np.isnan(scores)] = np.inf
+
+    top_n = min(top_n, len(scores))
+    candidates = np.argpartition(scores, top_n - 1)[:top_n]
+    # Sort by score, then by row for a stable order among equal scores
+    return candidates[np.lexsort((candidates, scores[candidates]))]
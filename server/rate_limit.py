@@ -0,0 +1,217 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from spotipy import SpotifyException
+
+from metrics import Gauge, Histogram, InstrumentedSession, endpoint_label, registry, spotify_retries
+
+logger = logging.getLogger(__name__)
+
+# App-wide budget for Spotify calls: a steady rate plus a burst allowance.
+# Spotify rate limits per app, so this is shared by every user. 0 disables
+# the budget, leaving only Retry-After handling.
+SPOTIFY_RATE_LIMIT = float(os.environ.get('SPOTIFY_RATE_LIMIT', 20))
+SPOTIFY_RATE_BURST = int(os.environ.get('SPOTIFY_RATE_BURST', 40))
+# Longest a call may queue before it's failed with a 429 of our own
+SPOTIFY_MAX_QUEUE_SECONDS = float(os.environ.get('SPOTIFY_MAX_QUEUE_SECONDS', 30))
+# Attempts per call when Spotify answers 429
+SPOTIFY_RATE_LIMIT_ATTEMPTS = int(os.environ.get('SPOTIFY_RATE_LIMIT_ATTEMPTS', 4))
+# Retries per call when Spotify answers with a server error, spotipy's default
+SPOTIFY_SERVER_ERROR_RETRIES = int(os.environ.get('SPOTIFY_SERVER_ERROR_RETRIES', 3))
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+
+# Queue order, most urgent first: profile lookups and listings a user is
+# waiting on, then generation, then library syncs and bulk lookups
+PRIORITIES = ('interactive', 'default', 'background')
+
+_priority = contextvars.ContextVar('spotify_priority', default='default')
+
+queue_wait_seconds = registry.register(Histogram(
+    'spotify_queue_wait_seconds', 'Time Spotify calls waited for the rate limit scheduler', ['priority']
+))
+
+@contextmanager
+def priority(name):
+    """Send the Spotify calls made in this block with the given priority.
+
+    Threads started from here only inherit it if they run in a copy of the
+    context, e.g. `pool.submit(contextvars.copy_context().run, fn)`.
+    """
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority {name!r}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class RateLimited(SpotifyException):
+    """A call that couldn't be sent in time because of the rate limit.
+
+    Raised as a SpotifyException with status 429 and a Retry-After header,
+    so it's handled like a 429 from Spotify itself.
+    """
+
+    def __init__(self, retry_after, url=''):
+        retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(429, -1, f"{url}:\n Rate limited, retry in {retry_after}s", headers={'Retry-After': str(retry_after)})
+        self.retry_after = retry_after
+
+class SpotifyScheduler:
+    """Admits outbound Spotify calls one at a time, by priority, within a token bucket.
+
+    When Spotify answers 429 every call is held back for its Retry-After,
+    since the limit applies to the whole app rather than one request.
+    """
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_RATE_BURST, max_wait=SPOTIFY_MAX_QUEUE_SECONDS):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_wait = max_wait
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        # Nothing accrues while paused, so calls resume at the steady rate
+        # rather than in one burst
+        accrued = now - max(self._updated, self._paused_until)
+        if self.rate > 0 and accrued > 0:
+            self._tokens = min(self.burst, self._tokens + accrued * self.rate)
+        self._updated = now
+
+    def acquire(self, url=''):
+        """Wait for this call's turn. Returns seconds waited; raises RateLimited past max_wait."""
+        rank = PRIORITIES.index(_priority.get())
+        ticket = (rank, next(self._sequence))
+        start = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    head = self._waiting[0] == ticket
+                    if head and now >= self._paused_until and (self.rate <= 0 or self._tokens >= 1):
+                        self._tokens -= 1
+                        heapq.heappop(self._waiting)
+                        # Let the next caller in line check its turn
+                        self._cond.notify_all()
+                        break
+
+                    remaining = self.max_wait - (now - start)
+                    if self._paused_until - now > remaining or remaining <= 0:
+                        raise RateLimited(max(self._paused_until - now, 1), url)
+                    if head:
+                        until_token = (1 - self._tokens) / self.rate if self.rate > 0 else 0
+                        self._cond.wait(min(remaining, max(self._paused_until - now, until_token, 0.001)))
+                    else:
+                        self._cond.wait(remaining)
+            except BaseException:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                raise
+        waited = time.monotonic() - start
+        queue_wait_seconds.observe(waited, PRIORITIES[rank])
+        return waited
+
+    def pause(self, seconds):
+        """Hold every call back for `seconds`, e.g. after a 429 with Retry-After."""
+        with self._cond:
+            self._refill(time.monotonic())
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 1.0)
+            self._cond.notify_all()
+        logger.warning(f"Spotify rate limit hit, pausing outbound calls for {seconds:.1f}s")
+
+    def share(self, processes):
+        """Scale the budget down to this process's share when several serve the app."""
+        with self._cond:
+            self.rate /= processes
+            self.burst = max(1, self.burst // processes)
+            self._tokens = min(self._tokens, self.burst)
+
+    def queue_depth(self):
+        with self._cond:
+            counts = dict.fromkeys(PRIORITIES, 0)
+            for rank, _ in self._waiting:
+                counts[PRIORITIES[rank]] += 1
+        return [((name,), count) for name, count in counts.items()]
+
+    def pause_remaining(self):
+        return [((), max(0.0, self._paused_until - time.monotonic()))]
+
+def backoff_delay(response, attempt):
+    """Seconds to wait after a 429: Retry-After if given, else exponential, plus jitter.
+
+    The jitter keeps callers that were paused together from all retrying in
+    the same instant.
+    """
+    try:
+        delay = float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        delay = 0.5 * 2 ** (attempt - 1)
+    return delay + random.uniform(0, min(1.0, delay / 2) + 0.1)
+
+def server_error_delay(retry):
+    """Seconds to wait before retrying a server error, as urllib3 would back off."""
+    return 0.3 * 2 ** (retry - 1)
+
+class ScheduledSession(InstrumentedSession):
+    """A session whose calls all go through the scheduler.
+
+    429 responses pause the scheduler and are retried here, so waiting for
+    the rate limit to clear holds back every caller, not just this one.
+    Server errors are retried here too, after a backoff for this call only.
+    Every attempt takes its own token, so an outage can't exceed the budget.
+    """
+
+    def __init__(
+        self, scheduler, attempts=SPOTIFY_RATE_LIMIT_ATTEMPTS, server_error_retries=SPOTIFY_SERVER_ERROR_RETRIES
+    ):
+        super().__init__()
+        self.scheduler = scheduler
+        self.attempts = attempts
+        self.server_error_retries = server_error_retries
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 1
+        server_errors = 0
+        while True:
+            self.scheduler.acquire(url)
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code == 429 and attempt < self.attempts:
+                delay = backoff_delay(response, attempt)
+                attempt += 1
+            elif response.status_code in SERVER_ERROR_STATUSES and server_errors < self.server_error_retries:
+                server_errors += 1
+                delay = server_error_delay(server_errors)
+            else:
+                return response
+            spotify_retries.inc(endpoint_label(url), str(response.status_code))
+            response.close()
+            if response.status_code == 429:
+                self.scheduler.pause(delay)
+            else:
+                time.sleep(delay)
+
+scheduler = SpotifyScheduler()
+
+registry.register(Gauge(
+    'spotify_queue_depth', 'Spotify calls waiting for the rate limit scheduler', ['priority'], scheduler.queue_depth
+))
+registry.register(Gauge(
+    'spotify_rate_limit_pause_seconds', 'Seconds left before paused Spotify calls resume', [], scheduler.pause_remaining
+))
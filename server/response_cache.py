@@ -0,0 +1,78 @@
+import logging
+import os
+
+from feature_store import feature_store
+from metrics import CollectedCounter, registry
+from shared_cache import SharedCache
+from tracks import Track
+
+logger = logging.getLogger(__name__)
+
+# Recommendation responses kept per worker, shared by every user and with
+# other workers through the library store
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 1024))
+RECOMMENDATION_CACHE_TTL_SECONDS = int(os.environ.get('RECOMMENDATION_CACHE_TTL_SECONDS', 3600))
+# Step that target features are rounded to, on the 0-1 scale. Coarser steps
+# let more near-identical prompts share a response.
+RECOMMENDATION_TARGET_PRECISION = float(os.environ.get('RECOMMENDATION_TARGET_PRECISION', 0.05))
+
+# Targets that aren't on a 0-1 scale, with the size of their range, so
+# tempo is rounded to 5 BPM and loudness to 1 dB at the default precision
+TARGET_SCALES = {'target_tempo': 100, 'target_loudness': 20, 'target_popularity': 100}
+
+_recommendations = SharedCache(
+    'recommendations', RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL_SECONDS,
+    encode=lambda tracks: [track.to_record() for track in tracks],
+    decode=lambda records: [Track.from_record(record) for record in records]
+)
+
+def quantize_targets(params, precision=None):
+    """Round `target_*` values in recommendation params to the precision step."""
+    precision = RECOMMENDATION_TARGET_PRECISION if precision is None else precision
+    if precision <= 0:
+        return dict(params)
+    quantized = {}
+    for name, value in params.items():
+        if name.startswith(('target_', 'min_', 'max_')) and isinstance(value, (int, float)):
+            step = precision * TARGET_SCALES.get(name, 1)
+            value = round(round(value / step) * step, 4)
+        quantized[name] = value
+    return quantized
+
+def recommendation_key(params):
+    """A cache key for recommendation params: seeds in any order and case map to one key."""
+    key = []
+    for name, value in sorted(params.items()):
+        if isinstance(value, (list, tuple)):
+            value = tuple(sorted(str(v).strip().lower() if name == 'seed_genres' else v for v in value))
+        key.append((name, value))
+    return tuple(key)
+
+def recommendations(sp, **params):
+    """Spotify recommendations as Tracks, from cache when an equivalent request was made.
+
+    Targets are quantized before the request is sent, so the response
+    cached for a key is the one Spotify gives for exactly those params.
+    """
+    params = quantize_targets({name: value for name, value in params.items() if value is not None})
+    key = recommendation_key(params)
+    tracks = _recommendations.get(key)
+    if tracks is None:
+        tracks = [Track.from_spotify(track) for track in sp.recommendations(**params)['tracks']]
+        _recommendations.set(key, tracks)
+    else:
+        logger.info(f"Recommendations for {dict(key)} served from cache")
+    # A copy, so callers can reorder it without touching the cached list
+    return list(tracks)
+
+def stats():
+    return {"recommendations": _recommendations.stats(), "audioFeatures": feature_store.stats()}
+
+def _lookups():
+    for cache, cache_stats in stats().items():
+        yield (cache, 'hit'), cache_stats['hits']
+        yield (cache, 'miss'), cache_stats['misses']
+
+registry.register(CollectedCounter(
+    'response_cache_lookups_total', 'Lookups in the Spotify response caches since startup', ['cache', 'result'], _lookups
+))
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import random
+import time
+from contextlib import closing
+
+from library_cache import connect
+from ttl_cache import TTLCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS shared_cache_expires_at ON shared_cache (namespace, expires_at);
+"""
+
+# Share of writes that also drop expired and surplus entries
+PRUNE_PROBABILITY = 0.01
+
+_schema_ready = False
+
+def _connect():
+    global _schema_ready
+    conn = connect()
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+def cache_key(key):
+    """A fixed-length text key. Keys are hashed, so tokens never reach the disk."""
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+class SharedCache:
+    """A TTLCache backed by the library store, shared by worker processes.
+
+    Lookups try this process's in-memory cache first and then the store, so
+    an entry cached by one worker serves the others and survives restarts.
+    Values are stored as JSON via `encode` and `decode`.
+    """
+
+    def __init__(self, namespace, maxsize, ttl, encode=None, decode=None):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self._local = TTLCache(maxsize, ttl)
+        self.shared_hits = 0
+
+    def get(self, key, default=None):
+        value = self._local.get(key)
+        if value is not None:
+            return value
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                'SELECT value, expires_at FROM shared_cache WHERE namespace = ? AND key = ? AND expires_at > ?',
+                (self.namespace, cache_key(key), time.time())
+            ).fetchone()
+        if row is None:
+            return default
+        value = self.decode(json.loads(row[0]))
+        self._local.set(key, value, ttl=row[1] - time.time())
+        self.shared_hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._local.set(key, value, ttl=ttl)
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO shared_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (self.namespace, cache_key(key), json.dumps(self.encode(value)), time.time() + ttl)
+            )
+            if random.random() < PRUNE_PROBABILITY:
+                self._prune(conn)
+
+    def pop(self, key, default=None):
+        value = self._local.pop(key, default)
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                'DELETE FROM shared_cache WHERE namespace = ? AND key = ?', (self.namespace, cache_key(key))
+            )
+        return value
+
+    def _prune(self, conn):
+        """Drop expired entries, then the ones closest to expiring beyond maxsize."""
+        conn.execute(
+            'DELETE FROM shared_cache WHERE namespace = ? AND expires_at <= ?', (self.namespace, time.time())
+        )
+        conn.execute(
+            'DELETE FROM shared_cache WHERE namespace = ? AND key IN ('
+            'SELECT key FROM shared_cache WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.maxsize)
+        )
+
+    def __len__(self):
+        return len(self._local)
+
+    def stats(self):
+        """The in-memory cache's stats; hits include those served from the store."""
+        stats = self._local.stats()
+        hits = self.shared_hits + stats['hits']
+        misses = stats['misses'] - self.shared_hits
+        stats.update({
+            "hits": hits,
+            "misses": misses,
+            "sharedHits": self.shared_hits,
+            "hitRate": round(hits / (hits + misses), 4) if hits + misses else None
+        })
+        return stats
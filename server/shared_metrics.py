@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import closing
+
+from jobs import process_alive
+from library_cache import connect
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS worker_metrics (
+    pid INTEGER PRIMARY KEY,
+    samples TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# How often each worker process publishes its metrics for the others to serve
+METRICS_PUBLISH_SECONDS = float(os.environ.get('METRICS_PUBLISH_SECONDS', 10))
+# Workers that haven't published for this many intervals are left out
+STALE_INTERVALS = 3
+
+_schema_ready = False
+
+def _connect():
+    global _schema_ready
+    conn = connect()
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+def publish():
+    """Store this process's samples, labelled with its pid."""
+    pid = os.getpid()
+    samples = registry.samples([('worker', str(pid))])
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO worker_metrics (pid, samples, updated_at) VALUES (?, ?, ?)',
+            (pid, json.dumps(samples), time.time())
+        )
+
+def render():
+    """Metrics of every live worker process, each series labelled with its worker.
+
+    This process publishes first, so its own samples are current; the
+    others' are at most METRICS_PUBLISH_SECONDS old. Workers that exited
+    are dropped, ending their series.
+    """
+    publish()
+    pid = os.getpid()
+    fresh_after = time.time() - METRICS_PUBLISH_SECONDS * STALE_INTERVALS
+    with closing(_connect()) as conn:
+        rows = conn.execute('SELECT pid, samples, updated_at FROM worker_metrics ORDER BY pid').fetchall()
+        gone = [
+            (row_pid,) for row_pid, _, updated_at in rows
+            if row_pid != pid and (updated_at < fresh_after or not process_alive(row_pid))
+        ]
+        if gone:
+            with conn:
+                conn.executemany('DELETE FROM worker_metrics WHERE pid = ?', gone)
+    gone = {row_pid for (row_pid,) in gone}
+    return registry.render([json.loads(samples) for row_pid, samples, _ in rows if row_pid not in gone])
+
+def start_publishing(interval=METRICS_PUBLISH_SECONDS):
+    """Publish this process's metrics every `interval` seconds, e.g. from a gunicorn worker."""
+    def run():
+        while True:
+            try:
+                publish()
+            except Exception as e:
+                logger.warning(f"Publishing metrics failed: {str(e)}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='metrics-publisher', daemon=True).start()
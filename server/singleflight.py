@@ -0,0 +1,92 @@
+import logging
+import threading
+from concurrent.futures import Future, wait
+
+from metrics import Counter, registry
+
+logger = logging.getLogger(__name__)
+
+# How often a caller waiting on another's call passes on its progress, which
+# is also when a cancelled job notices
+WAIT_POLL_SECONDS = 0.5
+
+coalesced_calls = registry.register(Counter(
+    'spotify_coalesced_calls', 'Calls answered by an identical call already in flight', ['call']
+))
+
+class _Flight:
+    def __init__(self):
+        self.future = Future()
+        # Latest (stage, counts) the running call reported
+        self.progress = None
+
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving meanwhile share its result.
+
+    Nothing is kept once the call finishes, so this only merges concurrent
+    work, e.g. a double-clicked generate or a batch of prompts on one source.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, retry_on=()):
+        """Return `fn()`, or the result of the identical call in flight for `key`.
+
+        Its exceptions are raised in every caller, except those in `retry_on`,
+        which belong to the caller that ran it (e.g. its job was cancelled):
+        the others then try again themselves.
+        """
+        return self.do_reporting(key, lambda report: fn(), retry_on=retry_on)
+
+    def do_reporting(self, key, fn, progress=None, retry_on=()):
+        """Like do, for a `fn(progress)` that reports progress as it goes.
+
+        Every caller's `progress` hears what the call reports. Callers waiting
+        on another's call pass on its latest progress every WAIT_POLL_SECONDS
+        from their own thread, so an exception there, such as JobCancelled,
+        stops only that caller's wait.
+        """
+        while True:
+            with self._lock:
+                flight = self._calls.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._calls[key] = _Flight()
+            if leader:
+                break
+            coalesced_calls.inc(self.name)
+            # The caller's own progress raises here, outside of retry_on
+            self._wait(flight, progress)
+            try:
+                return flight.future.result()
+            except retry_on:
+                continue
+
+        def report(stage, **counts):
+            flight.progress = (stage, counts)
+            if progress:
+                progress(stage, **counts)
+
+        try:
+            result = fn(report)
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        else:
+            flight.future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def _wait(self, flight, progress):
+        """Wait for another caller's call to finish, passing on its progress."""
+        while progress and not flight.future.done():
+            wait([flight.future], timeout=WAIT_POLL_SECONDS)
+            if flight.progress:
+                # Repeats are fine: a job only records changes, but checks
+                # for cancellation every time
+                progress(flight.progress[0], **flight.progress[1])
@@ -0,0 +1,91 @@
+import logging
+import os
+
+import requests
+import spotipy
+
+from rate_limit import ScheduledSession, priority, scheduler
+from shared_cache import SharedCache
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to api.spotify.com, shared by every request. Size it
+# to the number of server threads plus the parallel fetch workers.
+SPOTIFY_POOL_SIZE = int(os.environ.get('SPOTIFY_POOL_SIZE', 32))
+SPOTIFY_REQUEST_TIMEOUT = float(os.environ.get('SPOTIFY_REQUEST_TIMEOUT', 10))
+# Clients and profiles are cached per access token
+SPOTIFY_CLIENT_CACHE_SIZE = int(os.environ.get('SPOTIFY_CLIENT_CACHE_SIZE', 256))
+PROFILE_TTL_SECONDS = int(os.environ.get('PROFILE_TTL_SECONDS', 300))
+# Spotify access tokens are valid for an hour
+TOKEN_TTL_SECONDS = 3600
+# Base URL of the Web API. Point it at benchmarks/fake_spotify.py to run
+# without a Spotify account.
+SPOTIFY_API_PREFIX = os.environ.get('SPOTIFY_API_PREFIX', 'https://api.spotify.com/v1/')
+
+class PooledSpotify(spotipy.Spotify):
+    """A Spotify client on the shared session.
+
+    spotipy closes its session when a client is garbage collected, which
+    would drop every pooled connection when one cached client is evicted.
+    """
+
+    def __del__(self):
+        pass
+
+def build_session(pool_size=SPOTIFY_POOL_SIZE):
+    """A requests session with a keep-alive connection pool.
+
+    Every call through it waits its turn with the rate limit scheduler and
+    is counted and timed for /api/metrics. Retryable statuses are retried by
+    the session, so each attempt goes through the scheduler; urllib3 only
+    retries connections that failed before a request was sent.
+    """
+    session = ScheduledSession(scheduler)
+    retry = requests.adapters.Retry(
+        total=spotipy.Spotify.max_retries,
+        connect=None,
+        read=False,
+        backoff_factor=0.3,
+        # urllib3 would otherwise retry 429s and 503s that carry Retry-After
+        respect_retry_after_header=False
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class SpotifyClientRegistry:
+    """Hands out one reusable client per access token, all on one session.
+
+    Also caches each token's profile, so looking up the user id doesn't
+    cost a round trip on every request. Profiles are shared with the other
+    worker processes through the library store; clients are per process.
+    """
+
+    def __init__(self, session, max_clients=SPOTIFY_CLIENT_CACHE_SIZE, profile_ttl=PROFILE_TTL_SECONDS):
+        self.session = session
+        self._clients = TTLCache(max_clients, TOKEN_TTL_SECONDS)
+        self._profiles = SharedCache('profiles', max_clients, profile_ttl)
+
+    def client(self, token):
+        sp = self._clients.get(token)
+        if sp is None:
+            sp = PooledSpotify(auth=token, requests_session=self.session, requests_timeout=SPOTIFY_REQUEST_TIMEOUT)
+            sp.prefix = SPOTIFY_API_PREFIX
+            self._clients.set(token, sp)
+        return sp
+
+    def current_user(self, token):
+        """The profile for a token, from cache when it's fresh enough."""
+        profile = self._profiles.get(token)
+        if profile is None:
+            with priority('interactive'):
+                profile = self.client(token).current_user()
+            self._profiles.set(token, profile)
+        return profile
+
+    def stats(self):
+        return {"clients": self._clients.stats(), "profiles": self._profiles.stats()}
+
+spotify_clients = SpotifyClientRegistry(build_session())
@@ -0,0 +1,77 @@
+import sys
+
+def _year(release_date):
+    try:
+        return int((release_date or '')[:4])
+    except ValueError:
+        return None
+
+class Track:
+    """The parts of a Spotify track the backend uses.
+
+    A full track from the API carries album objects, image lists and ~180
+    market codes; this keeps a few scalars per track instead. Artist and
+    album strings are interned, so tracks by the same artist share them.
+    """
+
+    __slots__ = ('id', 'name', 'popularity', 'duration_ms', 'artist_ids', 'artist_names', 'album', 'release_year')
+
+    def __init__(self, id, name, popularity=0, duration_ms=0, artist_ids=(), artist_names=(), album=None, release_year=None):
+        self.id = id
+        self.name = name
+        self.popularity = popularity
+        self.duration_ms = duration_ms
+        self.artist_ids = tuple(sys.intern(a) for a in artist_ids)
+        self.artist_names = tuple(sys.intern(a) for a in artist_names)
+        self.album = sys.intern(album) if album else None
+        self.release_year = release_year
+
+    @property
+    def uri(self):
+        return f"spotify:track:{self.id}"
+
+    @classmethod
+    def from_spotify(cls, track):
+        """Build from a track object as returned by the Web API."""
+        artists = [artist for artist in track.get('artists') or () if artist.get('id')]
+        album = track.get('album') or {}
+        return cls(
+            track['id'],
+            track.get('name') or '',
+            track.get('popularity') or 0,
+            track.get('duration_ms') or 0,
+            [artist['id'] for artist in artists],
+            [artist.get('name') or '' for artist in artists],
+            album.get('name'),
+            _year(album.get('release_date'))
+        )
+
+    def to_record(self):
+        """A JSON-serializable list, the form stored in the library cache."""
+        return [
+            self.id, self.name, self.popularity, self.duration_ms,
+            list(self.artist_ids), list(self.artist_names), self.album, self.release_year
+        ]
+
+    @classmethod
+    def from_record(cls, record):
+        """Inverse of to_record. Full API tracks cached by older versions are accepted too."""
+        if isinstance(record, dict):
+            return cls.from_spotify(record)
+        return cls(*record)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "uri": self.uri,
+            "name": self.name,
+            "popularity": self.popularity,
+            "durationMs": self.duration_ms,
+            "artistIds": list(self.artist_ids),
+            "artists": list(self.artist_names),
+            "album": self.album,
+            "releaseYear": self.release_year
+        }
+
+    def __repr__(self):
+        return f"Track({self.id!r}, {self.name!r})"